@@ -0,0 +1,226 @@
+import argparse
+import concurrent.futures
+import inspect
+import json
+import multiprocessing
+import os
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import psutil
+
+from benchmarks import synthetic_data
+from evaluate import detectors, estimate_hub_height, interpolators, locators
+from evaluate.sun_position import SunPosition
+from prep_images import crop_turbines, photo_store
+from prep_images.load_photo_metadata import load_photo_metadata
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+def main(
+    root="data/benchmark",
+    num_turbines=1000,
+    benchmarks=None,
+    regenerate=False,
+    **generate_kwargs,
+):
+    """Run each benchmark against synthetic data, in a new process so peak memory is separate.
+
+    The synthetic data is generated first if it is missing or was generated with different
+    options. Results are printed and saved to benchmark_results.csv in root.
+    """
+    root = Path(root).resolve()
+    settings_path = root / "synthetic_data.json"
+    options = inspect.signature(synthetic_data.generate).bind(root, num_turbines, **generate_kwargs)
+    options.apply_defaults()
+    if settings_path.exists() and not regenerate:
+        with open(settings_path) as f:
+            settings = json.load(f)
+        regenerate = any(
+            settings.get(name) != value
+            for name, value in options.arguments.items()
+            if name != "root"
+        )
+    else:
+        regenerate = True
+    if regenerate:
+        synthetic_data.generate(root, num_turbines, **generate_kwargs)
+
+    results = []
+    for name in benchmarks or BENCHMARKS:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            result = executor.submit(run_benchmark, name, str(root)).result()
+        print(
+            f"{name}: {result['items']} items in {result['seconds']:.3f}s, "
+            f"{result['items_per_second']:.1f}/s, peak RSS {result['peak_rss_mb']:.0f}MB"
+        )
+        results.append(result)
+    pd.DataFrame(results).to_csv(root / "benchmark_results.csv", index=False)
+    return results
+
+
+def run_benchmark(name, root):
+    os.chdir(root)
+    items, seconds = BENCHMARKS[name]()
+    return {
+        "benchmark": name,
+        "items": items,
+        "seconds": seconds,
+        "items_per_second": items / seconds if seconds > 0 else np.inf,
+        "peak_rss_mb": peak_rss_bytes() / 1024**2,
+    }
+
+
+def peak_rss_bytes():
+    if resource is None:
+        return psutil.Process().memory_info().peak_wset
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and macOS reports bytes
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+def load_turbines():
+    """Turbine metadata with the site location and photo time, and the base of each turbine."""
+    turbines = pd.read_csv("data/turbine_image_metadata.csv")
+    sites = pd.read_csv("data/site_photo_metadata.csv")
+    return turbines.merge(
+        sites[["site", "latitude", "longitude", "photo_timestamp"]], on="site"
+    ).assign(
+        base_x=lambda x: x.turbine_corner_x + x.max_size * x.resolution / 2,
+        base_y=lambda x: x.turbine_corner_y - x.max_size * x.resolution / 2,
+    )
+
+
+def benchmark_elevation():
+    turbines = load_turbines()
+    elevation_interpolator = interpolators.ElevationInterpolator()
+    start = time.perf_counter()
+    elevation_interpolator.get_elevations_xy(turbines.base_x, turbines.base_y)
+    return len(turbines), time.perf_counter() - start
+
+
+def benchmark_coordinates():
+    turbines = load_turbines()
+    rng = np.random.default_rng(0)
+    object_x, object_y = rng.uniform(size=len(turbines)), rng.uniform(size=len(turbines))
+    start = time.perf_counter()
+    estimate_hub_height.calculate_coordinates(object_x, object_y, turbines, turbines.zone)
+    return len(turbines), time.perf_counter() - start
+
+
+def benchmark_photo_lookup():
+    turbines = load_turbines()
+    photo_metadata = load_photo_metadata()
+    start = time.perf_counter()
+    locators.PhotoLocator(photo_metadata).nearest(turbines.base_x, turbines.base_y)
+    return len(turbines), time.perf_counter() - start
+
+
+def benchmark_photo_store():
+    turbines = load_turbines()
+    start = time.perf_counter()
+    photo_metadata = photo_store.PhotoStore().query_radius(turbines.base_x, turbines.base_y)
+    locators.PhotoLocator(photo_metadata).nearest(turbines.base_x, turbines.base_y)
+    return len(turbines), time.perf_counter() - start
+
+
+def benchmark_sun_position():
+    turbines = load_turbines()
+    sun_position = SunPosition()
+    start = time.perf_counter()
+    sun_position.altaz(
+        turbines.latitude, turbines.longitude, pd.to_datetime(turbines.photo_timestamp, utc=True)
+    )
+    return len(turbines), time.perf_counter() - start
+
+
+def benchmark_crop_turbines():
+    # Remove the manifest, so that every site is cropped
+    Path("data/manifest/crop_turbines.json").unlink(missing_ok=True)
+    os.environ["full_site_labels"] = synthetic_data.FULL_LABELS
+    start = time.perf_counter()
+    crop_turbines.main(site_image_suffix=".tif")
+    seconds = time.perf_counter() - start
+    return len(pd.read_csv("data/turbine_image_metadata.csv")), seconds
+
+
+def benchmark_estimate_hub_height():
+    run_name = synthetic_data.RUN_NAME
+    Path(f"data/manifest/estimate_hub_height_{run_name}.json").unlink(missing_ok=True)
+    start = time.perf_counter()
+    estimate_hub_height.main(run_name)
+    seconds = time.perf_counter() - start
+    return len(list(Path(f"hub_shadow_model/runs/detect/{run_name}/labels").glob("*"))), seconds
+
+
+def benchmark_estimate_hub_height_stub():
+    """Estimate hub heights with a stub detector, which finds the squares in synthetic images."""
+    run_name = f"{synthetic_data.RUN_NAME}_stub"
+    image_path = Path(
+        f"data/hub_shadow_data/all_unlabelled_images/{synthetic_data.RUN_NAME}/images"
+    )
+    detector = detectors.StubDetector(find_synthetic_labels)
+    Path(f"data/manifest/estimate_hub_height_{run_name}.json").unlink(missing_ok=True)
+    start = time.perf_counter()
+    estimate_hub_height.main(run_name, detector=detector, image_path=image_path)
+    seconds = time.perf_counter() - start
+    return len(list(image_path.glob("*"))), seconds
+
+
+def find_synthetic_labels(image):
+    """Labels for the base and hub shadow squares drawn in a synthetic turbine image"""
+    size = image.shape[0]
+    labels = []
+    for label, shade in enumerate(synthetic_data.LABEL_SHADES):
+        rows, columns = np.nonzero(image[:, :, 0] == shade)
+        if len(rows) > 0:
+            labels.append(
+                [
+                    label,
+                    (columns.min() + columns.max() + 1) / 2 / size,
+                    (rows.min() + rows.max() + 1) / 2 / size,
+                    (columns.max() - columns.min() + 1) / size,
+                    (rows.max() - rows.min() + 1) / size,
+                    0.9,
+                ]
+            )
+    return labels
+
+
+BENCHMARKS = {
+    "elevation": benchmark_elevation,
+    "coordinates": benchmark_coordinates,
+    "photo_lookup": benchmark_photo_lookup,
+    "photo_store": benchmark_photo_store,
+    "sun_position": benchmark_sun_position,
+    "crop_turbines": benchmark_crop_turbines,
+    "estimate_hub_height": benchmark_estimate_hub_height,
+    "estimate_hub_height_stub": benchmark_estimate_hub_height_stub,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=main.__doc__.splitlines()[0])
+    parser.add_argument("num_turbines", nargs="?", type=int, default=1000)
+    parser.add_argument("--root", default="data/benchmark")
+    parser.add_argument("--benchmarks", nargs="*", choices=list(BENCHMARKS))
+    parser.add_argument("--regenerate", action="store_true")
+    parser.add_argument("--binary-dem", action="store_true")
+    args = parser.parse_args()
+    main(
+        args.root,
+        args.num_turbines,
+        args.benchmarks,
+        args.regenerate,
+        binary_dem=args.binary_dem,
+    )
@@ -0,0 +1,435 @@
+import json
+import math
+import os
+import shutil
+import string
+from pathlib import Path
+
+import cv2
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from osgeo import gdal, osr
+from shapely.geometry import box
+
+from evaluate import elevation_tiles, transforms
+from evaluate.sun_position import SunPosition
+from prep_images import crop_turbines, load_photo_metadata, photo_store
+
+# Names used for the synthetic Roboflow export and YOLOv7 detection run
+FULL_LABELS = "synthetic"
+RUN_NAME = "benchmark"
+
+# Sites are laid out on a grid in UTM zone 30, starting in central Spain. Each site image is
+# 2km wide, so sites are spaced far enough apart not to overlap
+ORIGIN_X = 400000
+ORIGIN_Y = 4400000
+SITE_SPACING = 2500
+ZONE = 30
+
+# MDT05 sheets are 10km squares. Grids extend two cells beyond the sheet, so that neighbouring
+# sheets overlap as they do in the real tiles
+DEM_TILE_WIDTH = 10000
+DEM_MARGIN_CELLS = 2
+
+HUB_HEIGHTS = [67, 78, 80, 100, 119]
+
+# Grey levels of the base and hub shadow squares drawn in the synthetic turbine images
+BACKGROUND_SHADE = 120
+LABEL_SHADES = [20, 60]
+
+
+def main():
+    generate()
+
+
+def generate(
+    root="data/benchmark",
+    num_turbines=1000,
+    turbines_per_site=10,
+    resolution=2.0,
+    dem_cellsize=25,
+    binary_dem=False,
+    photos_per_site=5,
+    site_images=True,
+    seed=0,
+):
+    """Generate a synthetic data directory with the same layout as the real data.
+
+    Writes site and orthophoto metadata, GeoTIFF site images, Roboflow style turbine labels,
+    the photo metadata cache and photo store, MDT05 ascii tiles with their coverage
+    shapefile, YOLOv7 hub shadow labels and the turbine images they were detected from. Hub
+    shadows are placed using the sun position at the photo time, so the estimates are close to
+    the actual hub heights. Paths in the pipeline are relative, so stages should be run from
+    root.
+    """
+    root = Path(root).resolve()
+    root.mkdir(parents=True, exist_ok=True)
+    ephemeris_file = Path("de421.bsp").resolve()
+    previous_path = os.getcwd()
+    os.chdir(root)
+    try:
+        if ephemeris_file.exists() and not Path("de421.bsp").exists():
+            shutil.copy(ephemeris_file, "de421.bsp")
+        rng = np.random.default_rng(seed)
+        sites = generate_sites(rng, num_turbines, turbines_per_site)
+        photos = generate_photos(rng, sites, photos_per_site)
+        write_site_metadata(sites, photos, resolution)
+        write_turbine_labels(rng, sites, turbines_per_site)
+        turbines = write_turbine_metadata()
+        if site_images:
+            write_site_images(sites, turbines, resolution)
+        write_elevation_tiles(turbines, dem_cellsize, binary_dem)
+        write_hub_shadow_labels(rng, sites, turbines)
+        write_unlabelled_images(turbines)
+        Path("data/plots").mkdir(parents=True, exist_ok=True)
+
+        with open("synthetic_data.json", "w") as f:
+            json.dump(
+                {
+                    "num_turbines": len(turbines),
+                    "num_sites": len(sites),
+                    "num_photos": len(photos),
+                    "turbines_per_site": turbines_per_site,
+                    "photos_per_site": photos_per_site,
+                    "resolution": resolution,
+                    "dem_cellsize": dem_cellsize,
+                    "binary_dem": binary_dem,
+                    "site_images": site_images,
+                    "seed": seed,
+                },
+                f,
+                indent=2,
+            )
+    finally:
+        os.chdir(previous_path)
+    print(f"Generated {len(turbines)} turbines at {len(sites)} sites in {root}")
+
+
+def site_name(site_num):
+    """Site names only use letters, because turbine numbers are parsed from _{number}_"""
+    letters = ""
+    for _ in range(4):
+        site_num, remainder = divmod(site_num, 26)
+        letters = string.ascii_lowercase[remainder] + letters
+    return f"site_{letters}"
+
+
+def generate_sites(rng, num_turbines, turbines_per_site):
+    num_sites = math.ceil(num_turbines / turbines_per_site)
+    columns = math.ceil(math.sqrt(num_sites))
+    site_nums = np.arange(num_sites)
+    sites = pd.DataFrame(
+        {
+            "site": [site_name(site_num) for site_num in site_nums],
+            "num_turbines": np.minimum(
+                turbines_per_site, num_turbines - site_nums * turbines_per_site
+            ),
+            "site_x": ORIGIN_X + (site_nums % columns + 0.5) * SITE_SPACING,
+            "site_y": ORIGIN_Y + (site_nums // columns + 0.5) * SITE_SPACING,
+            "hub_height": rng.choice(HUB_HEIGHTS, num_sites),
+            # Photos for each site are taken on one flight, in summer between 09:00 and 15:00
+            "photo_timestamp": pd.to_datetime("2019-06-01", utc=True)
+            + pd.to_timedelta(rng.integers(0, 100, num_sites), unit="D")
+            + pd.to_timedelta(rng.integers(9 * 3600, 15 * 3600, num_sites), unit="s"),
+        }
+    )
+    latitude, longitude = transforms.transform_utm(
+        sites.site_x, sites.site_y, ZONE, "EPSG:4326"
+    )
+    return sites.assign(latitude=latitude, longitude=longitude)
+
+
+def generate_photos(rng, sites, photos_per_site):
+    """Write the photo metadata cache and photo store, so that no databases are needed."""
+    # The first photo of each site is near its centre, and the others are scattered around it
+    distance = rng.uniform(0, 2500, (len(sites), photos_per_site))
+    distance[:, 0] = rng.uniform(0, 500, len(sites))
+    angle = rng.uniform(0, 2 * np.pi, (len(sites), photos_per_site))
+    photo_x = sites.site_x.to_numpy()[:, None] + distance * np.sin(angle)
+    photo_y = sites.site_y.to_numpy()[:, None] + distance * np.cos(angle)
+    latitude, longitude = transforms.transform_utm(
+        photo_x.ravel(), photo_y.ravel(), ZONE, "EPSG:4326"
+    )
+    photo_timestamps = pd.DatetimeIndex(sites.photo_timestamp).repeat(
+        photos_per_site
+    ) + pd.to_timedelta(np.tile(np.arange(photos_per_site) * 10, len(sites)), unit="s")
+    photo_table = pd.DataFrame(
+        {
+            "photo_file": [
+                f"PNOA_2019_{site}_{photo_num}.tif"
+                for site in sites.site
+                for photo_num in range(photos_per_site)
+            ],
+            "photo_latitude": latitude,
+            "photo_longitude": longitude,
+            "photo_timestamp": photo_timestamps,
+        }
+    )
+    photos = load_photo_metadata.build_photo_table([photo_table])
+
+    # There are no zip or database files, so the cache key is for empty signatures
+    cache_path = Path("data/photo_metadata/cache")
+    cache_path.mkdir(parents=True, exist_ok=True)
+    photos.to_parquet(cache_path / load_photo_metadata.PHOTO_TABLE_FILE)
+    load_photo_metadata.write_cache_manifest(
+        cache_path,
+        {
+            "key": load_photo_metadata.photo_cache_key({}, {}),
+            "zip_files": {},
+            "databases": {},
+            "failed_files": [],
+        },
+    )
+
+    # Also write the photo store, which hub height estimation uses if it exists
+    photo_store.PHOTO_STORE_PATH.unlink(missing_ok=True)
+    store = photo_store.PhotoStore()
+    store.import_photos("synthetic", photo_table)
+    store.close()
+    return photos
+
+
+def write_site_metadata(sites, photos, resolution):
+    # Joined to the nearest photo in the same way as load_photo_metadata.main
+    site_photos = gpd.sjoin_nearest(
+        gpd.GeoDataFrame(
+            sites.drop(columns="photo_timestamp"),
+            geometry=gpd.points_from_xy(sites.site_x, sites.site_y),
+            crs="EPSG:25830",
+        ),
+        photos.to_geodataframe().drop(columns="photo_centroid"),
+        how="left",
+    ).drop_duplicates("site").sort_index()
+    orthophoto_names = [f"PNOA_MA_OF_ETRS89_HU{ZONE}_H50_{n:04d}" for n in range(len(sites))]
+    Path("data").mkdir(exist_ok=True)
+    pd.DataFrame(
+        {
+            "site": sites.site,
+            "latitude": sites.latitude,
+            "longitude": sites.longitude,
+            "num_turbines": [str((n,)) for n in sites.num_turbines],
+            "hub_height": [str((float(h),)) for h in sites.hub_height],
+            "photo_file": site_photos.photo_file.to_numpy(),
+            "photo_timestamp": site_photos.photo_timestamp.to_numpy(),
+            "orthophoto_name": orthophoto_names,
+            "site_x": sites.site_x,
+            "site_y": sites.site_y,
+            "HUSO": ZONE,
+            "new": False,
+        }
+    ).to_csv("data/site_photo_metadata.csv", index=False)
+    pd.DataFrame(
+        {
+            "site": sites.site,
+            "name": orthophoto_names,
+            "resolution": resolution,
+            "zone": ZONE,
+            "corner_x": sites.site_x - 1000,
+            "corner_y": sites.site_y + 1000,
+        }
+    ).to_csv("data/orthophoto_metadata.csv", index=False)
+
+
+def write_turbine_labels(rng, sites, turbines_per_site):
+    """Write Roboflow style labels for each site image, split between train, valid and test."""
+    labels_path = Path(f"data/turbine_shadow_data/{FULL_LABELS}")
+    if labels_path.exists():
+        shutil.rmtree(labels_path)
+    split = np.arange(len(sites)) % 10
+    datasets = np.where(split < 7, "train", np.where(split < 9, "valid", "test"))
+    for dataset in ["train", "valid", "test"]:
+        (labels_path / dataset / "labels").mkdir(parents=True)
+
+    # Turbines are placed on a jittered grid in the middle of the site image, so they do not
+    # overlap. A turbine shadow label is included for each turbine, and ignored when cropping
+    grid_width = math.ceil(math.sqrt(turbines_per_site))
+    for site_num, (site, site_turbines) in enumerate(zip(sites.site, sites.num_turbines)):
+        turbine_nums = np.arange(site_turbines)
+        center_x = 0.3 + 0.4 * (turbine_nums % grid_width + 0.5) / grid_width
+        center_y = 0.3 + 0.4 * (turbine_nums // grid_width + 0.5) / grid_width
+        center_x += rng.uniform(-0.01, 0.01, site_turbines)
+        center_y += rng.uniform(-0.01, 0.01, site_turbines)
+        lines = [f"0 {x:.6f} {y:.6f} 0.020000 0.020000" for x, y in zip(center_x, center_y)]
+        lines += [
+            f"1 {x:.6f} {y + 0.02:.6f} 0.030000 0.050000" for x, y in zip(center_x, center_y)
+        ]
+        label_path = labels_path / datasets[site_num] / "labels" / f"{site}_png.rf.synthetic.txt"
+        label_path.write_text("\n".join(lines) + "\n")
+
+
+def write_turbine_metadata():
+    """Write the turbine image metadata which crop_turbines would create, with empty images.
+
+    Hub height estimation only checks that each turbine image exists. The images are replaced
+    when crop_turbines is run.
+    """
+    orthophotos = pd.read_csv("data/orthophoto_metadata.csv")
+    turbines = crop_turbines.load_turbine_labels(FULL_LABELS, orthophotos, ".tif")
+    for dataset, site, turbine_num in zip(turbines.dataset, turbines.site, turbines.turbine_num):
+        image_path = Path(f"data/turbine_images/{dataset}/{site}_{turbine_num}.png")
+        if not image_path.exists():
+            image_path.parent.mkdir(parents=True, exist_ok=True)
+            image_path.touch()
+    turbines.drop(columns=["dataset", "image_path"]).to_csv(
+        "data/turbine_image_metadata.csv", index=False
+    )
+    return turbines
+
+
+def write_site_images(sites, turbines, resolution):
+    """Write a tiled, compressed GeoTIFF for each site, as crop_orthophotos does for COGs."""
+    Path("data/site_images").mkdir(parents=True, exist_ok=True)
+    size = int(2000 / resolution)
+    spatial_reference = osr.SpatialReference()
+    spatial_reference.ImportFromEPSG(25830)
+    driver = gdal.GetDriverByName("GTiff")
+    turbine_groups = dict(list(turbines.groupby("site")))
+    for site in sites.itertuples():
+        # Fields with a slight gradient, and a dark square for each turbine base
+        image_data = np.empty((3, size, size), dtype=np.uint8)
+        image_data[:] = (np.arange(size) * 40 // size + 100).astype(np.uint8)[None, :, None]
+        site_turbines = turbine_groups.get(site.site)
+        if site_turbines is not None:
+            for turbine in site_turbines.itertuples():
+                half_width = max(turbine.width_px // 2, 1)
+                image_data[
+                    :,
+                    max(turbine.center_y_px - half_width, 0) : turbine.center_y_px + half_width,
+                    max(turbine.center_x_px - half_width, 0) : turbine.center_x_px + half_width,
+                ] = 40
+
+        image = driver.Create(
+            f"data/site_images/{site.site}.tif",
+            size,
+            size,
+            3,
+            gdal.GDT_Byte,
+            options=["TILED=YES", "COMPRESS=DEFLATE"],
+        )
+        image.SetGeoTransform(
+            [site.site_x - 1000, resolution, 0, site.site_y + 1000, 0, -resolution]
+        )
+        image.SetProjection(spatial_reference.ExportToWkt())
+        image.WriteArray(image_data)
+        image = None
+
+
+def synthetic_elevation(x, y):
+    """Smooth hills between roughly 200m and 1000m"""
+    return (
+        600 + 300 * np.sin(x / 7000) * np.cos(y / 9000) + 100 * np.sin((x + y) / 2500)
+    ).astype(np.float32)
+
+
+def write_elevation_tiles(turbines, cellsize, binary_dem=False):
+    """Write MDT05 ascii tiles for every 10km sheet with a turbine, and the coverage shapefile."""
+    files_path = Path("data/digital_elevation/files")
+    coverage_path = Path("data/digital_elevation/coverage")
+    files_path.mkdir(parents=True, exist_ok=True)
+    coverage_path.mkdir(parents=True, exist_ok=True)
+
+    # Hub shadows are within a turbine image of the turbine, so pad the extent by 1.5km
+    turbine_x = turbines.turbine_corner_x.to_numpy()
+    turbine_y = turbines.turbine_corner_y.to_numpy()
+    columns = np.arange(
+        np.floor((turbine_x.min() - 1500) / DEM_TILE_WIDTH),
+        np.floor((turbine_x.max() + 1500) / DEM_TILE_WIDTH) + 1,
+    ).astype(int)
+    rows = np.arange(
+        np.floor((turbine_y.min() - 1500) / DEM_TILE_WIDTH),
+        np.floor((turbine_y.max() + 1500) / DEM_TILE_WIDTH) + 1,
+    ).astype(int)
+
+    cells = int(DEM_TILE_WIDTH / cellsize) + 2 * DEM_MARGIN_CELLS + 1
+    tiles = []
+    for row in rows:
+        for column in columns:
+            filename = f"PNOA_MDT05_ETRS89_HU{ZONE}_{row:04d}_{column:04d}_LID.asc"
+            left, bottom = column * DEM_TILE_WIDTH, row * DEM_TILE_WIDTH
+            x_values = left - DEM_MARGIN_CELLS * cellsize + np.arange(cells) * cellsize
+            y_values = bottom - DEM_MARGIN_CELLS * cellsize + np.arange(cells) * cellsize
+            elevation_data = synthetic_elevation(x_values[None, :], y_values[::-1, None])
+            with open(files_path / filename, "w") as f:
+                f.write(
+                    f"NCOLS {cells}\nNROWS {cells}\nXLLCENTER {x_values[0]}\n"
+                    f"YLLCENTER {y_values[0]}\nCELLSIZE {cellsize}\nNODATA_VALUE -999\n"
+                )
+                # Rows end with a space and the file ends with an empty line, as in MDT05 tiles
+                np.savetxt(f, elevation_data, fmt="%.2f", newline=" \n")
+                f.write("\n")
+            if binary_dem:
+                elevation_tiles.convert_elevation_tile(filename)
+            tiles.append(
+                {
+                    "FICHERO": filename,
+                    "geometry": box(left, bottom, left + DEM_TILE_WIDTH, bottom + DEM_TILE_WIDTH),
+                }
+            )
+    gpd.GeoDataFrame(tiles, crs="EPSG:25830").to_file(coverage_path / "MDT05.shp")
+
+
+def write_hub_shadow_labels(rng, sites, turbines):
+    """Write YOLOv7 labels for a base and hub shadow in each turbine image.
+
+    The hub shadow is offset from the base by the shadow of the hub height at the sun position
+    for the site photo. One in twenty turbines has no hub shadow label.
+    """
+    labels_path = Path(f"hub_shadow_model/runs/detect/{RUN_NAME}/labels")
+    if labels_path.exists():
+        shutil.rmtree(labels_path)
+    labels_path.mkdir(parents=True)
+
+    turbines = turbines.merge(
+        sites[["site", "latitude", "longitude", "hub_height", "photo_timestamp"]], on="site"
+    )
+    altitude, azimuth = SunPosition().altaz(
+        turbines.latitude, turbines.longitude, turbines.photo_timestamp
+    )
+    shadow_length = turbines.hub_height / np.tan(np.radians(altitude))
+    scale = turbines.resolution * turbines.max_size
+    base_x = (turbines.center_x_px - turbines.left_offset) / turbines.max_size
+    base_y = (turbines.center_y_px - turbines.top_offset) / turbines.max_size
+    hub_x = base_x - shadow_length * np.sin(np.radians(azimuth)) / scale
+    hub_y = base_y + shadow_length * np.cos(np.radians(azimuth)) / scale
+    has_hub = rng.uniform(size=len(turbines)) >= 0.05
+
+    for turbine_num, turbine in enumerate(turbines.itertuples()):
+        lines = [
+            f"0 {base_x.iloc[turbine_num]:.6f} {base_y.iloc[turbine_num]:.6f} 0.05 0.05 0.9"
+        ]
+        if has_hub[turbine_num]:
+            lines.append(
+                f"1 {hub_x.iloc[turbine_num]:.6f} {hub_y.iloc[turbine_num]:.6f} 0.03 0.03 0.8"
+            )
+        label_name = f"{turbine.site}_{turbine.turbine_num}_png.rf.synthetic.txt"
+        (labels_path / label_name).write_text("\n".join(lines) + "\n")
+
+
+def write_unlabelled_images(turbines):
+    """Write a turbine image for each set of hub shadow labels, with a square for each label.
+
+    Each label is drawn in its LABEL_SHADES grey on a plain background, so a stub detector can
+    find the labels again from the image.
+    """
+    labels_path = Path(f"hub_shadow_model/runs/detect/{RUN_NAME}/labels")
+    images_path = Path(f"data/hub_shadow_data/all_unlabelled_images/{RUN_NAME}/images")
+    if images_path.exists():
+        shutil.rmtree(images_path)
+    images_path.mkdir(parents=True)
+    for turbine in turbines.itertuples():
+        name = f"{turbine.site}_{turbine.turbine_num}_png.rf.synthetic"
+        image = np.full((turbine.max_size, turbine.max_size, 3), BACKGROUND_SHADE, dtype=np.uint8)
+        labels = np.loadtxt(labels_path / f"{name}.txt", ndmin=2)
+        for label, center_x, center_y, width, height, _ in labels:
+            left, right = np.clip(
+                np.round((center_x + np.array([-width, width]) / 2) * turbine.max_size), 0, None
+            ).astype(int)
+            top, bottom = np.clip(
+                np.round((center_y + np.array([-height, height]) / 2) * turbine.max_size), 0, None
+            ).astype(int)
+            image[top:bottom, left:right] = LABEL_SHADES[int(label)]
+        cv2.imwrite(str(images_path / f"{name}.png"), image)
+
+if __name__ == "__main__":
+    main()
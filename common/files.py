@@ -0,0 +1,7 @@
+from pathlib import Path
+
+
+def file_signature(path):
+    """Size and modification time, used to detect changed source files"""
+    stat = Path(path).stat()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
@@ -0,0 +1,96 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+
+class Manifest:
+    """Content hashes of the inputs and outputs of each site or turbine in a pipeline stage.
+
+    Stages use the manifest to skip items whose inputs, dependencies and outputs have not changed
+    since the last run. File hashes are cached against size and modification time, so large
+    files such as orthophotos are only read again when they change.
+    """
+
+    def __init__(self, stage, path="data/manifest"):
+        self.path = Path(path) / f"{stage}.json"
+        try:
+            with open(self.path) as f:
+                contents = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            contents = {}
+        self.items = contents.get("items", {})
+        self.files = contents.get("files", {})
+
+    def hash_file(self, path):
+        """SHA-1 of the file contents, or None if the file does not exist."""
+        path = str(path)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        cached = self.files.get(path)
+        if cached is not None and cached["size"] == stat.st_size:
+            if cached["mtime_ns"] == stat.st_mtime_ns:
+                return cached["sha1"]
+
+        file_hash = hashlib.sha1()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                file_hash.update(block)
+        self.files[path] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha1": file_hash.hexdigest(),
+        }
+        return self.files[path]["sha1"]
+
+    def hash_inputs(self, inputs, files=()):
+        """SHA-1 of a json serialisable set of input values and the contents of input files."""
+        return hashlib.sha1(
+            json.dumps(
+                {"inputs": inputs, "files": {str(f): self.hash_file(f) for f in files}},
+                sort_keys=True,
+                default=to_json_value,
+            ).encode()
+        ).hexdigest()
+
+    def is_current(self, key, inputs, files=()):
+        """True if the inputs and recorded dependencies are unchanged and the outputs exist."""
+        item = self.items.get(key)
+        if item is None or item["inputs"] != self.hash_inputs(inputs, files):
+            return False
+        for path, file_hash in (item["dependencies"] | item["outputs"]).items():
+            if self.hash_file(path) != file_hash:
+                return False
+        return True
+
+    def record(self, key, inputs, files=(), outputs=(), dependencies=(), data=None):
+        """Record an item after it has been processed.
+
+        Dependencies are files which are only known once the item has been processed, such as
+        the elevation tiles used for a turbine. Data is returned by get_data on later runs.
+        """
+        self.items[key] = {
+            "inputs": self.hash_inputs(inputs, files),
+            "dependencies": {str(path): self.hash_file(path) for path in dependencies},
+            "outputs": {str(path): self.hash_file(path) for path in outputs},
+            "data": json.loads(json.dumps(data, default=to_json_value)),
+        }
+
+    def get_data(self, key):
+        return self.items[key]["data"]
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temporary_path = self.path.with_suffix(".tmp")
+        with open(temporary_path, "w") as f:
+            json.dump({"items": self.items, "files": self.files}, f)
+        os.replace(temporary_path, self.path)
+
+
+def to_json_value(value):
+    """Convert numpy scalars and other values which json cannot serialise."""
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
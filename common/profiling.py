@@ -0,0 +1,131 @@
+import collections
+import contextlib
+import cProfile
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+# Latency histogram bins in seconds, from 10 microseconds to 100 seconds
+LATENCY_BINS = np.logspace(-5, 2, 15)
+
+
+class Profiler:
+    """Record wall and CPU time for each stage of the pipeline, with latencies and counters.
+
+    Stages can be nested, and are named with dots so that they group in the report. Set the
+    environment variable PIPELINE_CPROFILE to a directory to also write a cProfile file for each
+    outermost stage, which can be opened with snakeviz or compared with py-spy output.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.depth = 0
+        self.stages = collections.defaultdict(
+            lambda: {"calls": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0}
+        )
+        self.latencies = collections.defaultdict(list)
+        self.counters = collections.Counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        cprofile_path = os.getenv("PIPELINE_CPROFILE")
+        profile = cProfile.Profile() if cprofile_path and self.depth == 0 else None
+        if profile is not None:
+            profile.enable()
+        self.depth += 1
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.depth -= 1
+            self.stages[name]["calls"] += 1
+            self.stages[name]["wall_seconds"] += time.perf_counter() - wall_start
+            self.stages[name]["cpu_seconds"] += time.process_time() - cpu_start
+            if profile is not None:
+                profile.disable()
+                os.makedirs(cprofile_path, exist_ok=True)
+                profile.dump_stats(os.path.join(cprofile_path, f"{name}.prof"))
+
+    def add_stage(self, name, wall_seconds, cpu_seconds):
+        """Record a call of a stage which was timed in another thread, such as a prefetch read."""
+        self.stages[name]["calls"] += 1
+        self.stages[name]["wall_seconds"] += wall_seconds
+        self.stages[name]["cpu_seconds"] += cpu_seconds
+
+    @contextlib.contextmanager
+    def latency(self, name):
+        """Record the latency of one item, such as a single turbine."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.latencies[name].append(time.perf_counter() - start)
+
+    def count(self, name, increment=1):
+        self.counters[name] += increment
+
+    def state(self):
+        """Stages, latencies and counters, which can be returned from a worker process."""
+        return {
+            "stages": dict(self.stages),
+            "latencies": dict(self.latencies),
+            "counters": dict(self.counters),
+        }
+
+    def merge(self, state):
+        """Add the stages, latencies and counters recorded by a worker process."""
+        for name, values in state["stages"].items():
+            for key, value in values.items():
+                self.stages[name][key] += value
+        for name, values in state["latencies"].items():
+            self.latencies[name].extend(values)
+        self.counters.update(state["counters"])
+
+    def report(self):
+        latencies = {}
+        for name, values in self.latencies.items():
+            values = np.array(values)
+            histogram, _ = np.histogram(values, bins=LATENCY_BINS)
+            latencies[name] = {
+                "count": len(values),
+                "mean_seconds": values.mean(),
+                "p50_seconds": np.percentile(values, 50),
+                "p95_seconds": np.percentile(values, 95),
+                "max_seconds": values.max(),
+                "histogram_bins_seconds": LATENCY_BINS.tolist(),
+                "histogram_counts": histogram.tolist(),
+            }
+        return {
+            "stages": dict(self.stages),
+            "latencies": latencies,
+            "counters": dict(self.counters),
+        }
+
+    def save(self, path_prefix):
+        """Write the report to {path_prefix}_profile.json and {path_prefix}_profile.csv"""
+        report = self.report()
+        with open(f"{path_prefix}_profile.json", "w") as f:
+            json.dump(report, f, indent=2, default=float)
+
+        rows = [
+            {"type": "stage", "name": name} | values for name, values in report["stages"].items()
+        ]
+        rows += [
+            {"type": "latency", "name": name}
+            | {key: value for key, value in values.items() if not key.startswith("histogram")}
+            for name, values in report["latencies"].items()
+        ]
+        rows += [
+            {"type": "counter", "name": name, "count": value}
+            for name, value in report["counters"].items()
+        ]
+        pd.DataFrame(rows).to_csv(f"{path_prefix}_profile.csv", index=False)
+
+
+# Shared by every stage in a process
+profiler = Profiler()
@@ -0,0 +1,170 @@
+import abc
+
+import cv2
+import numpy as np
+
+from evaluate import prefetch
+
+# Columns written by YOLOv7 detect.py with --save-txt --save-conf
+LABEL_COLUMNS = ["label", "center_x", "center_y", "width", "height", "confidence"]
+
+
+class Detector(abc.ABC):
+    """Detect bases and hub shadows in batches of turbine images, without writing label files.
+
+    Subclasses implement detect(), which takes a list of RGB images and returns an array of
+    labels for each image. Each row is label, center_x, center_y, width, height and confidence,
+    relative to the image size and sorted by descending confidence, as in the YOLOv7 label files.
+    """
+
+    batch_size = 32
+
+    @abc.abstractmethod
+    def detect(self, images):
+        pass
+
+    def detect_files(self, image_paths, prefetch_depth=2):
+        """Generate (image_path, labels) for each image, running the detector in batches.
+
+        The next prefetch_depth batches of images are read in background threads while the
+        current batch is detected.
+        """
+        image_paths = list(image_paths)
+        batches = [
+            image_paths[batch_start : batch_start + self.batch_size]
+            for batch_start in range(0, len(image_paths), self.batch_size)
+        ]
+        for batch_paths, images in prefetch.prefetch(
+            read_images, batches, prefetch_depth, "detectors.images"
+        ):
+            yield from zip(batch_paths, self.detect(images))
+
+
+class StubDetector(Detector):
+    """Detector for tests and benchmarks, which returns the labels from a function of each image.
+
+    Without a function, no labels are returned for any image.
+    """
+
+    def __init__(self, predict=None):
+        self.predict = predict
+
+    def detect(self, images):
+        if self.predict is None:
+            return [np.empty((0, len(LABEL_COLUMNS))) for _ in images]
+        return [
+            np.asarray(self.predict(image), dtype=float).reshape(-1, len(LABEL_COLUMNS))
+            for image in images
+        ]
+
+
+class YoloDetector(Detector):
+    """Pre and post processing for YOLOv7 models exported with export.py --grid.
+
+    The exported model returns (batch, boxes, 5 + classes) with centre, size, objectness and
+    class scores in input pixels. Boxes are filtered and suppressed per class as in detect.py.
+    """
+
+    def __init__(self, image_size=640, conf_threshold=0.5, iou_threshold=0.45):
+        self.image_size = image_size
+        self.conf_threshold = conf_threshold
+        self.iou_threshold = iou_threshold
+
+    @abc.abstractmethod
+    def run(self, batch):
+        pass
+
+    def detect(self, images):
+        # Turbine images are square, so they are resized without letterboxing
+        batch = np.stack(
+            [cv2.resize(image, (self.image_size, self.image_size)) for image in images]
+        )
+        batch = np.ascontiguousarray(batch.transpose(0, 3, 1, 2), dtype=np.float32) / 255
+        predictions = self.run(batch)
+        return [self.postprocess(prediction) for prediction in predictions]
+
+    def postprocess(self, prediction):
+        class_scores = prediction[:, 5:] * prediction[:, 4:5]
+        labels = class_scores.argmax(axis=1)
+        confidence = class_scores.max(axis=1)
+        keep = confidence >= self.conf_threshold
+        boxes, labels, confidence = prediction[keep, :4], labels[keep], confidence[keep]
+
+        selected = []
+        for label in np.unique(labels):
+            in_class = np.nonzero(labels == label)[0]
+            keep_in_class = non_max_suppression(
+                boxes[in_class], confidence[in_class], self.iou_threshold
+            )
+            selected.extend(in_class[keep_in_class])
+        selected = np.array(sorted(selected, key=lambda i: -confidence[i]), dtype=int)
+
+        return np.column_stack(
+            [
+                labels[selected],
+                boxes[selected] / self.image_size,
+                confidence[selected],
+            ]
+        ).reshape(-1, len(LABEL_COLUMNS))
+
+
+class OnnxDetector(YoloDetector):
+    """YOLOv7 model exported to ONNX, run on the CPU with onnxruntime."""
+
+    def __init__(self, model_path, **kwargs):
+        super().__init__(**kwargs)
+        import onnxruntime
+
+        self.session = onnxruntime.InferenceSession(
+            str(model_path), providers=["CPUExecutionProvider"]
+        )
+        self.input_name = self.session.get_inputs()[0].name
+
+    def run(self, batch):
+        return self.session.run(None, {self.input_name: batch})[0]
+
+
+class TorchScriptDetector(YoloDetector):
+    """YOLOv7 model exported to TorchScript, run on the CPU."""
+
+    def __init__(self, model_path, **kwargs):
+        super().__init__(**kwargs)
+        import torch
+
+        self.torch = torch
+        self.model = torch.jit.load(str(model_path), map_location="cpu").eval()
+
+    def run(self, batch):
+        with self.torch.no_grad():
+            predictions = self.model(self.torch.from_numpy(batch))
+        if isinstance(predictions, (list, tuple)):
+            predictions = predictions[0]
+        return predictions.numpy()
+
+
+def non_max_suppression(boxes, scores, iou_threshold):
+    """Return the positions of boxes to keep, given centre x, centre y, width and height."""
+    left, top = boxes[:, 0] - boxes[:, 2] / 2, boxes[:, 1] - boxes[:, 3] / 2
+    right, bottom = boxes[:, 0] + boxes[:, 2] / 2, boxes[:, 1] + boxes[:, 3] / 2
+    areas = boxes[:, 2] * boxes[:, 3]
+    order = np.argsort(-scores, kind="stable")
+    keep = []
+    while len(order) > 0:
+        best, order = order[0], order[1:]
+        keep.append(best)
+        overlap_width = np.clip(
+            np.minimum(right[best], right[order]) - np.maximum(left[best], left[order]), 0, None
+        )
+        overlap_height = np.clip(
+            np.minimum(bottom[best], bottom[order]) - np.maximum(top[best], top[order]), 0, None
+        )
+        intersection = overlap_width * overlap_height
+        iou = intersection / (areas[best] + areas[order] - intersection)
+        order = order[iou <= iou_threshold]
+    return np.array(keep, dtype=int)
+
+
+def read_images(image_paths):
+    return [
+        cv2.cvtColor(cv2.imread(str(image_path)), cv2.COLOR_BGR2RGB) for image_path in image_paths
+    ]
@@ -0,0 +1,178 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from osgeo import gdal  # noqa
+
+from common.files import file_signature
+
+ASCII_PATH = Path("data/digital_elevation/files")
+BINARY_PATH = Path("data/digital_elevation/binary")
+
+
+def main():
+    """Convert every ascii MDT05 tile into the binary tile store."""
+    ascii_files = sorted(ASCII_PATH.glob("*.asc"))
+    for ascii_file in ascii_files:
+        if is_converted(ascii_file.name):
+            continue
+        convert_elevation_tile(ascii_file.name)
+        print(f"Converted {ascii_file.name}")
+    print("Done")
+
+
+def read_ascii_header(path):
+    """Read the six line header of an ESRI ascii grid."""
+    header = {}
+    with open(path) as f:
+        for _ in range(6):
+            key, value = f.readline().split()
+            header[key.upper()] = float(value)
+    return header
+
+
+def read_ascii_grid(path):
+    """Read an ESRI ascii grid, returning the header and float32 elevations with NaN nodata.
+
+    Row 0 of the elevations is the northern edge of the tile.
+    """
+    header = read_ascii_header(path)
+    elevation_data = pd.read_csv(
+        path,
+        skiprows=6,
+        nrows=int(header["NROWS"]),
+        usecols=range(int(header["NCOLS"])),
+        header=None,
+        sep=" ",
+        dtype=np.float32,
+    ).to_numpy()
+    elevation_data[elevation_data == header["NODATA_VALUE"]] = np.nan
+    return header, elevation_data
+
+
+def convert_elevation_tile(filename):
+    """Convert an ascii tile to a float32 .npy file, with a json header sidecar.
+
+    Rows are stored from south to north, so that both grid axes are ascending. The size and
+    modification time of the ascii tile are kept in the header, so that it is converted again
+    if the tile is replaced.
+    """
+    source_signature = file_signature(ASCII_PATH / filename)
+    header, elevation_data = read_ascii_grid(ASCII_PATH / filename)
+    BINARY_PATH.mkdir(parents=True, exist_ok=True)
+    stem = Path(filename).stem
+
+    # Write both files to temporary names and move them into place, the header last, so that
+    # other processes never map a partially written tile or treat it as complete
+    temporary_stem = f"{stem}.{os.getpid()}.tmp"
+    with open(BINARY_PATH / f"{temporary_stem}.npy", "wb") as f:
+        np.save(f, np.ascontiguousarray(elevation_data[::-1]))
+    with open(BINARY_PATH / f"{temporary_stem}.json", "w") as f:
+        json.dump(
+            {
+                "source": filename,
+                "source_signature": source_signature,
+                "ncols": int(header["NCOLS"]),
+                "nrows": int(header["NROWS"]),
+                "xllcenter": header["XLLCENTER"],
+                "yllcenter": header["YLLCENTER"],
+                "cellsize": header["CELLSIZE"],
+            },
+            f,
+            indent=2,
+        )
+    os.replace(BINARY_PATH / f"{temporary_stem}.npy", BINARY_PATH / f"{stem}.npy")
+    os.replace(BINARY_PATH / f"{temporary_stem}.json", BINARY_PATH / f"{stem}.json")
+
+
+def is_converted(filename):
+    """True if the binary tile exists, and matches the ascii tile if that is still present."""
+    stem = Path(filename).stem
+    try:
+        with open(BINARY_PATH / f"{stem}.json") as f:
+            header = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return False
+    if not (BINARY_PATH / f"{stem}.npy").exists():
+        return False
+    ascii_path = ASCII_PATH / filename
+    return not ascii_path.exists() or header.get("source_signature") == file_signature(ascii_path)
+
+
+def load_elevation_tile(filename):
+    """Memory map a binary tile, converting it from ascii the first time it is needed.
+
+    Returns the header, ascending y and x cell centres and the elevations. Pages are shared by
+    every process which maps the same tile. Raises FileNotFoundError if the ascii tile is missing.
+    """
+    if not is_converted(filename):
+        convert_elevation_tile(filename)
+
+    stem = Path(filename).stem
+    with open(BINARY_PATH / f"{stem}.json") as f:
+        header = json.load(f)
+    elevation_data = np.load(BINARY_PATH / f"{stem}.npy", mmap_mode="r")
+
+    x_values = header["xllcenter"] + np.arange(header["ncols"]) * header["cellsize"]
+    y_values = header["yllcenter"] + np.arange(header["nrows"]) * header["cellsize"]
+    return header, y_values, x_values, elevation_data
+
+
+def read_elevation_window(filename, x_coordinates, y_coordinates, padding=2):
+    """Read only the cells around a set of EPSG:25830 points, padded by a number of cells.
+
+    Uses the binary tile if it has been converted, otherwise reads a window of the ascii tile
+    through GDAL. Returns ascending y and x cell centres and the elevations. Raises
+    FileNotFoundError if the tile is missing.
+    """
+    if is_converted(filename):
+        header, y_values, x_values, elevation_data = load_elevation_tile(filename)
+        rows = window_range(y_coordinates, header["yllcenter"], header["cellsize"], padding)
+        columns = window_range(x_coordinates, header["xllcenter"], header["cellsize"], padding)
+        rows = slice(max(rows.start, 0), min(rows.stop, header["nrows"]))
+        columns = slice(max(columns.start, 0), min(columns.stop, header["ncols"]))
+        return y_values[rows], x_values[columns], np.asarray(elevation_data[rows, columns])
+
+    try:
+        dataset = gdal.Open(str(ASCII_PATH / filename))
+    except RuntimeError:
+        dataset = None
+    if dataset is None:
+        raise FileNotFoundError(filename)
+    left, cellsize, _, top, _, _ = dataset.GetGeoTransform()
+
+    # GDAL rows run from north to south, so measure them down from the top edge
+    rows = window_range(-np.asarray(y_coordinates), -top + cellsize / 2, cellsize, padding)
+    columns = window_range(x_coordinates, left + cellsize / 2, cellsize, padding)
+    rows = slice(max(rows.start, 0), min(rows.stop, dataset.RasterYSize))
+    columns = slice(max(columns.start, 0), min(columns.stop, dataset.RasterXSize))
+
+    band = dataset.GetRasterBand(1)
+    elevation_data = band.ReadAsArray(
+        columns.start,
+        rows.start,
+        columns.stop - columns.start,
+        rows.stop - rows.start,
+    ).astype(np.float32)
+    nodata_value = band.GetNoDataValue()
+    if nodata_value is not None:
+        elevation_data[elevation_data == nodata_value] = np.nan
+
+    x_values = left + (np.arange(columns.start, columns.stop) + 0.5) * cellsize
+    y_values = top - (np.arange(rows.start, rows.stop) + 0.5) * cellsize
+    return y_values[::-1], x_values, elevation_data[::-1]
+
+
+def window_range(coordinates, first_centre, cellsize, padding):
+    """Cell indices which cover the coordinates along one ascending axis, plus padding."""
+    positions = (np.asarray(coordinates, dtype=float) - first_centre) / cellsize
+    return slice(
+        int(np.floor(positions.min())) - padding,
+        int(np.ceil(positions.max())) + padding + 1,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,250 +1,768 @@
+import argparse
+import concurrent.futures
 import math
 import re
-from datetime import datetime
 from pathlib import Path
 
 import dotenv
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-from osgeo import gdal  # noqa
-from pyproj import Transformer
 from scipy import stats
-from shapely.geometry import Point
-from skyfield import api as skyfield_api
 from tqdm import tqdm
 
-from evaluate import interpolators
-from prep_images.load_photo_metadata import load_photo_metadata
+from common.manifest import Manifest
+from common.profiling import profiler
+from evaluate import detectors, interpolators, locators, prefetch, transforms, uncertainty
+from evaluate.sun_position import SunPosition
+from prep_images import photo_store, tile_catalog
+from prep_images.load_photo_metadata import PHOTO_TABLE_FILE, load_photo_metadata
 
+# Increase when the outputs for each turbine change, so that turbines are estimated again
+ESTIMATE_VERSION = 3
 
-def main(run_name):
-    start_time = datetime.now()
+# Each worker process keeps the ephemeris and elevation tiles loaded between shards
+worker_state = {}
+
+
+def main(
+    run_name, detector=None, image_path=None, uncertainty_draws=0, workers=1, prefetch_depth=2
+):
+    """Estimate hub heights from the hub shadow labels for a YOLOv7 detection run.
+
+    Labels are read from the detection run, or detected from image_path if a detector is given.
+    """
+    profiler.reset()
+    with profiler.stage("estimate_hub_height"):
+        if workers > 1:
+            if detector is not None:
+                raise ValueError("Sharded runs read label files, so a detector cannot be used")
+            prepare_shared_data()
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, initializer=init_worker
+            ) as executor:
+                futures = [
+                    executor.submit(
+                        estimate_shard,
+                        run_name,
+                        shard,
+                        workers,
+                        prefetch_depth,
+                        uncertainty_draws,
+                    )
+                    for shard in range(workers)
+                ]
+                for future in futures:
+                    profiler.merge(future.result())
+            merge_shards(run_name, workers, uncertainty_draws)
+        else:
+            estimate_hub_heights(
+                run_name, detector, image_path, uncertainty_draws, prefetch_depth
+            )
+    profiler.save(f"data/{run_name}")
+    duration = profiler.stages["estimate_hub_height"]["wall_seconds"]
+    print(f"Duration: {round(duration / 60, 1)} min")
+    for name, seconds in prefetch.stall_seconds().items():
+        print(f"Prefetch stall time for {name}: {seconds:.2f}s")
+
+
+def estimate_hub_heights(
+    run_name, detector=None, image_path=None, uncertainty_draws=0, prefetch_depth=2
+):
     dotenv.load_dotenv(".env")
     dotenv.load_dotenv(".env.secret")
 
-    sites = pd.read_csv("data/site_photo_metadata.csv")
-    turbines = pd.read_csv("data/turbine_image_metadata.csv")
-    label_paths = Path(f"hub_shadow_model/runs/detect/{run_name}/labels").glob("*")
+    with profiler.stage("estimate_hub_height.load_metadata"):
+        # Set up skyfield to calculate relative positions of the earth and sun
+        sun_position = SunPosition()
+        elevation_interpolator = interpolators.ElevationInterpolator(
+            prefetch_depth=prefetch_depth
+        )
+
+        if detector is None:
+            label_paths = schedule_turbines(
+                label_file_paths(run_name), elevation_interpolator.tile_catalog
+            )
+            turbine_labels = read_label_files(label_paths, prefetch_depth)
+        else:
+            if image_path is None:
+                image_path = f"data/hub_shadow_data/all_unlabelled_images/{run_name}/images"
+            image_paths = schedule_turbines(
+                Path(image_path).glob("*"), elevation_interpolator.tile_catalog
+            )
+            turbine_labels = (
+                (Path(path).name, pd.DataFrame(labels, columns=detectors.LABEL_COLUMNS))
+                for path, labels in detector.detect_files(image_paths, prefetch_depth)
+            )
+
+    turbine_list, _, missing_list = estimate_turbines(
+        turbine_labels,
+        sun_position,
+        elevation_interpolator,
+        f"estimate_hub_height_{run_name}",
+        uncertainty=uncertainty_draws > 0,
+    )
+    save_missing_files(run_name, missing_list)
+    report_results(run_name, pd.DataFrame(turbine_list), uncertainty_draws)
+
 
-    # Set up skyfield to calculate relative positions of the earth and sun
-    ephemeris = skyfield_api.load("de421.bsp")
-    earth, sun = ephemeris["earth"], ephemeris["sun"]
+def estimate_turbines(
+    turbine_labels,
+    sun_position,
+    elevation_interpolator,
+    manifest_name,
+    read_only=False,
+    uncertainty=False,
+):
+    """Estimate the hub height of each turbine from (label_name, labels) pairs.
 
-    # Load aerial photo data to find the nearest photo for each turbine
-    photo_metadata = load_photo_metadata()
-    transformer_to_30n = Transformer.from_crs(f"EPSG:4326", f"EPSG:25830")
-    elevation_interpolator = interpolators.ElevationInterpolator()
+    Returns a dict of results for each turbine and the label name of each turbine, sorted by
+    label name so that the results do not depend on the order the labels were estimated in, and
+    the elevation tiles which were missing for any of the turbines. If
+    read_only is set, the photo metadata cache is read as it is, as in shard workers. If
+    uncertainty is set, the label geometry and sun altitude rate used by
+    uncertainty.hub_height_intervals are added to the results.
+    """
+    with profiler.stage("estimate_hub_height.load_metadata"):
+        # Index sites, turbines and turbine images once, so the loop does no scans or globs
+        sites = pd.read_csv("data/site_photo_metadata.csv")
+        turbines = pd.read_csv("data/turbine_image_metadata.csv")
+        site_index = sites.drop_duplicates("site").set_index("site", drop=False)
+        turbine_index = turbines.drop_duplicates(["site", "turbine_num"]).set_index(
+            ["site", "turbine_num"], drop=False
+        )
+        turbine_image_paths = {}
+        for turbine_image_path in sorted(Path("data/turbine_images").glob("**/*.png")):
+            turbine_image_paths.setdefault(turbine_image_path.stem, turbine_image_path)
 
     turbine_regex = re.compile(r"_(\d+)_")
     hub_height_regex = re.compile(r"([0-9]*[.]?[0-9]+)")
+    # Turbines are only estimated again if their labels, metadata, photos or elevation tiles have
+    # changed since the last run
+    manifest = Manifest(manifest_name)
+    changed_turbines = {}
+    missing_tiles = {}
     turbine_list = []
-    for label_path in tqdm(list(label_paths)):
-        name_split = turbine_regex.split(label_path.name)
-        site = name_split[0]
-        turbine_num = int(name_split[1])
-        turbine = turbines.query("site == @site and turbine_num == @turbine_num").iloc[0]
-        site_metadata = sites[sites.site.eq(site)].iloc[0]
-
-        # Drop Ourol because the co-ordinates are for the wrong site with an
-        # unknown hub height.
-        if site in ["ourol"]:
-            continue
-
-        # Only Becerril has turbines listed with different heights
-        hub_heights = hub_height_regex.findall(site_metadata.hub_height)
-        if len(hub_heights) == 0:
-            actual_hub_height = np.nan
-        elif len(hub_heights) == 1 or hub_heights[0] == hub_heights[1]:
-            actual_hub_height = float(hub_heights[0])
-        elif len(hub_heights) > 1:
-            turbine_counts = hub_height_regex.findall(site_metadata.num_turbines)
-            actual_hub_height = np.average(
-                [float(h) for h in hub_heights], weights=[float(c) for c in turbine_counts]
-            )
-        else:
-            raise ValueError("Unable to calculate hub height")
-
-        labels = pd.read_csv(
-            label_path,
-            sep=" ",
-            names=["label", "center_x", "center_y", "width", "height", "confidence"],
-        )
-        turbine_metadata = {
-            "site": site,
-            "turbine_id": turbine_num,
-            "actual_hub_height": actual_hub_height,
-            "num_bases": labels.label.eq(0).sum(),
-            "num_hub_shadows": labels.label.eq(1).sum(),
-        }
+    turbine_keys = []
+    detection_list = []
+    for label_name, labels in tqdm(turbine_labels):
+        with profiler.latency("estimate_hub_height.turbine"):
+            profiler.count("turbines")
+            name_split = turbine_regex.split(label_name)
+            site = name_split[0]
+            turbine_num = int(name_split[1])
+            turbine = turbine_index.loc[(site, turbine_num)]
+            site_metadata = site_index.loc[site]
 
-        # The predicted labels are listed in order of confidence
-        if turbine_metadata["num_bases"] == 1 and turbine_metadata["num_hub_shadows"] == 1:
-            base_x, base_y = labels.query("label == 0").iloc[0, 1:3].values
-            hub_x, hub_y = labels.query("label == 1").iloc[0, 1:3].values
-        else:
-            # Models have not detected a base and a hub
-            turbine_list.append(turbine_metadata)
-            continue
+            # Drop Ourol because the co-ordinates are for the wrong site with an
+            # unknown hub height.
+            if site in ["ourol"]:
+                profiler.count("turbines_skipped.ourol")
+                continue
+            turbine_keys.append(label_name)
+
+            # Turbines without an image are skipped, so they are estimated again once it is added
+            turbine_inputs = {
+                "version": ESTIMATE_VERSION,
+                "labels": labels.to_numpy().tolist(),
+                "turbine": turbine.to_dict(),
+                "site": site_metadata.to_dict(),
+                "image_exists": f"{site}_{turbine_num}" in turbine_image_paths,
+                "uncertainty": uncertainty,
+            }
+            if manifest.is_current(label_name, turbine_inputs):
+                # The missing elevation tiles are kept, so the missing files list is complete
+                turbine_data = manifest.get_data(label_name)
+                missing_tiles[len(turbine_list)] = turbine_data["missing_files"]
+                turbine_list.append(turbine_data["turbine"])
+                profiler.count("turbines_skipped.up_to_date")
+                continue
+            changed_turbines[len(turbine_list)] = (label_name, turbine_inputs)
+
+            # Only Becerril has turbines listed with different heights
+            hub_heights = hub_height_regex.findall(site_metadata.hub_height)
+            if len(hub_heights) == 0:
+                actual_hub_height = np.nan
+            elif len(hub_heights) == 1 or hub_heights[0] == hub_heights[1]:
+                actual_hub_height = float(hub_heights[0])
+            elif len(hub_heights) > 1:
+                turbine_counts = hub_height_regex.findall(site_metadata.num_turbines)
+                actual_hub_height = np.average(
+                    [float(h) for h in hub_heights], weights=[float(c) for c in turbine_counts]
+                )
+            else:
+                raise ValueError("Unable to calculate hub height")
+
+            turbine_metadata = {
+                "site": site,
+                "turbine_id": turbine_num,
+                "actual_hub_height": actual_hub_height,
+                "num_bases": labels.label.eq(0).sum(),
+                "num_hub_shadows": labels.label.eq(1).sum(),
+            }
+
+            # The predicted labels are listed in order of confidence
+            if turbine_metadata["num_bases"] == 1 and turbine_metadata["num_hub_shadows"] == 1:
+                base_label = labels.query("label == 0").iloc[0]
+                hub_label = labels.query("label == 1").iloc[0]
+                base_x, base_y = base_label.center_x, base_label.center_y
+                hub_x, hub_y = hub_label.center_x, hub_label.center_y
+            else:
+                # Models have not detected a base and a hub
+                turbine_list.append(turbine_metadata)
+                profiler.count("turbines_skipped.missing_labels")
+                continue
+
+            # Calculate shadow length and sun azimuth from labels (compass heading of the shadow)
+            if f"{site}_{turbine_num}" not in turbine_image_paths:
+                # Images have been removed from dataset (example Almendarache)  # noqa
+                turbine_list.append(turbine_metadata)
+                profiler.count("turbines_skipped.missing_image")
+                continue
+
+            # Calculate label positions within the image. Turbine images are max_size square
+            x_distance = (base_x - hub_x) * turbine.max_size * turbine.resolution
+            y_distance = (base_y - hub_y) * turbine.max_size * turbine.resolution
+            shadow_length = (x_distance**2 + y_distance**2) ** 0.5
+            if x_distance >= 0:
+                shadow_azimuth = 90 + math.atan(y_distance / x_distance) * 180 / math.pi
+            else:
+                shadow_azimuth = 270 + math.atan(y_distance / x_distance) * 180 / math.pi
 
-        # Calculate shadow length and sun azimuth from labels (compass heading of the shadow)
-        try:
-            image_path = next(Path("data/turbine_images").glob(f"**/{site}_{turbine_num}.png"))
-        except StopIteration:
-            # Images have been removed from dataset (example Almendarache)  # noqa
             turbine_list.append(turbine_metadata)
-            continue
-
-        # Calculate label positions within the image
-        image = gdal.Open(str(image_path))
-        x_distance = (base_x - hub_x) * image.RasterXSize * turbine.resolution
-        y_distance = (base_y - hub_y) * image.RasterYSize * turbine.resolution
-        shadow_length = (x_distance**2 + y_distance**2) ** 0.5
-        if x_distance >= 0:
-            shadow_azimuth = 90 + math.atan(y_distance / x_distance) * 180 / math.pi
-        else:
-            shadow_azimuth = 270 + math.atan(y_distance / x_distance) * 180 / math.pi
+            detection_list.append(
+                {
+                    "turbine_index": len(turbine_list) - 1,
+                    "shadow_length": shadow_length,
+                    "shadow_azimuth": shadow_azimuth,
+                    "base_x": base_x,
+                    "base_y": base_y,
+                    "hub_x": hub_x,
+                    "hub_y": hub_y,
+                    "base_box_width": base_label.width,
+                    "base_box_height": base_label.height,
+                    "base_confidence": base_label.confidence,
+                    "hub_box_width": hub_label.width,
+                    "hub_box_height": hub_label.height,
+                    "hub_confidence": hub_label.confidence,
+                    "turbine_corner_x": turbine.turbine_corner_x,
+                    "turbine_corner_y": turbine.turbine_corner_y,
+                    "resolution": turbine.resolution,
+                    "max_size": turbine.max_size,
+                    "zone": site_metadata.HUSO,
+                }
+            )
+
+    # Find the timestamp for the nearest aerial photo to every turbine base
+    detections = pd.DataFrame(
+        detection_list,
+        columns=[
+            "turbine_index",
+            "shadow_length",
+            "shadow_azimuth",
+            "base_x",
+            "base_y",
+            "hub_x",
+            "hub_y",
+            "base_box_width",
+            "base_box_height",
+            "base_confidence",
+            "hub_box_width",
+            "hub_box_height",
+            "hub_confidence",
+            "turbine_corner_x",
+            "turbine_corner_y",
+            "resolution",
+            "max_size",
+            "zone",
+        ],
+    )
 
-        # Calculate label latitude and longitude
-        base_latitude, base_longitude = calculate_coordinates(
-            base_x, base_y, turbine, site_metadata.HUSO
+    with profiler.stage("estimate_hub_height.coordinates"):
+        # Calculate label coordinates for all turbines, with one transform per UTM zone
+        base_utm_x, base_utm_y = calculate_utm_coordinates(
+            detections.base_x, detections.base_y, detections
         )
-        hub_latitude, hub_longitude = calculate_coordinates(
-            hub_x, hub_y, turbine, site_metadata.HUSO
+        hub_utm_x, hub_utm_y = calculate_utm_coordinates(
+            detections.hub_x, detections.hub_y, detections
         )
-
-        # Find the timestamp for the nearest aerial photo
-        point_x, point_y = transformer_to_30n.transform(base_latitude, base_longitude)
-        base_point = Point(point_x, point_y)
-        area_around_turbine = base_point.buffer(3100)
-        nearest_photo = (
-            photo_metadata[photo_metadata.within(area_around_turbine)]
-            .assign(distance_to_centroid=lambda x: x.distance(base_point))
-            .sort_values("distance_to_centroid")
+        base_latitude, base_longitude = transforms.transform_utm(
+            base_utm_x, base_utm_y, detections.zone, "EPSG:4326"
+        )
+        hub_latitude, hub_longitude = transforms.transform_utm(
+            hub_utm_x, hub_utm_y, detections.zone, "EPSG:4326"
+        )
+        point_x, point_y = transforms.transform_utm(
+            base_utm_x, base_utm_y, detections.zone, "EPSG:25830"
+        )
+        hub_point_x, hub_point_y = transforms.transform_utm(
+            hub_utm_x, hub_utm_y, detections.zone, "EPSG:25830"
         )
-        if nearest_photo.shape[0] > 0:
-            nearest_photo = nearest_photo.iloc[0]
+        detections = detections.assign(
+            base_latitude=base_latitude,
+            base_longitude=base_longitude,
+            hub_latitude=hub_latitude,
+            hub_longitude=hub_longitude,
+            point_x=point_x,
+            point_y=point_y,
+            hub_point_x=hub_point_x,
+            hub_point_y=hub_point_y,
+        )
+
+    with profiler.stage("estimate_hub_height.photo_lookup"):
+        # Find the nearest aerial photo for each turbine. If the photo store is up to date with
+        # the photo databases, only the photos near the turbines are read
+        if photo_store.store_is_current():
+            photo_source_path = photo_store.PHOTO_STORE_PATH
+            photo_table = photo_store.PhotoStore().query_radius(
+                detections.point_x, detections.point_y, 3100
+            )
         else:
-            turbine_list.append(turbine_metadata)
-            continue
+            photo_source_path = f"data/photo_metadata/cache/{PHOTO_TABLE_FILE}"
+            photo_table = load_photo_metadata(read_only=read_only)
+        photo_locator = locators.PhotoLocator(photo_table)
+        photo_positions = photo_locator.nearest(detections.point_x, detections.point_y)
+        profiler.count("photo_lookups", len(photo_positions))
+        profiler.count("turbines_skipped.no_photo", int((photo_positions < 0).sum()))
 
-        # Calculate the sun altitude and azimuth from the timestamp
-        observer = earth + skyfield_api.wgs84.latlon(
-            latitude_degrees=base_latitude, longitude_degrees=base_longitude
+        # Only the timestamps and file names of the nearest photos are kept for the run
+        found = photo_positions >= 0
+        detections = detections[found].assign(
+            photo_timestamp=photo_table.photo_timestamp(photo_positions[found]),
+            photo_file=photo_table.photo_file(photo_positions[found]),
         )
-        time = skyfield_api.load.timescale().from_datetime(nearest_photo.photo_timestamp)
-        altitude, azimuth, _ = observer.at(time).observe(sun).apparent().altaz()
-        shadow_height = math.tan(altitude.radians) * shadow_length
+        del photo_locator, photo_table
 
-        # Include topology correction.
-        base_height = elevation_interpolator.get_elevation(base_latitude, base_longitude)
-        hub_shadow_height = elevation_interpolator.get_elevation(hub_latitude, hub_longitude)
+    with profiler.stage("estimate_hub_height.sun_position"):
+        # Calculate the sun altitude and azimuth from the timestamps, for all turbines at once
+        photo_timestamps = pd.DatetimeIndex(detections.photo_timestamp)
+        altitude, azimuth = sun_position.altaz(
+            detections.base_latitude, detections.base_longitude, photo_timestamps
+        )
+        if uncertainty:
+            # The rate of change of altitude is used to estimate the effect of timestamp errors
+            later_altitude, _ = sun_position.altaz(
+                detections.base_latitude,
+                detections.base_longitude,
+                photo_timestamps + pd.Timedelta(seconds=60),
+            )
+            detections = detections.assign(altitude_rate=(later_altitude - altitude) / 60)
+        detections = detections.assign(
+            altitude=altitude,
+            azimuth=azimuth,
+            shadow_height=lambda x: np.tan(np.radians(x.altitude)) * x.shadow_length,
+            azimuth_diff=lambda x: np.abs(x.shadow_azimuth.astype(int) - x.azimuth.astype(int)),
+        )
+
+    with profiler.stage("estimate_hub_height.elevation"):
+        # Include topology correction, grouping base and hub shadow points by elevation tile
+        elevations = elevation_interpolator.get_elevations_xy(
+            np.concatenate([detections.point_x, detections.hub_point_x]),
+            np.concatenate([detections.point_y, detections.hub_point_y]),
+        )
+        detections = detections.assign(
+            base_height=elevations[: len(detections)],
+            hub_shadow_height=elevations[len(detections) :],
+            height_correction=lambda x: (x.base_height - x.hub_shadow_height).fillna(0),
+        )
 
-        height_correction = base_height - hub_shadow_height
-        if np.isnan(height_correction):
-            height_correction = 0
+    for detection in detections.itertuples():
+        base_latitude, base_longitude = detection.base_latitude, detection.base_longitude
+        hub_latitude, hub_longitude = detection.hub_latitude, detection.hub_longitude
+        shadow_height = detection.shadow_height
+        base_height, hub_shadow_height = detection.base_height, detection.hub_shadow_height
+        height_correction = detection.height_correction
         estimated_hub_height = round(shadow_height - height_correction, 1)
 
-        turbine_list.append(
-            turbine_metadata
-            | {
-                "actual_hub_height": actual_hub_height,
-                "estimated_hub_height": estimated_hub_height,
-                "hub_height_diff": estimated_hub_height - actual_hub_height,
-                "shadow_height": round(shadow_height, 1),
-                "base_height": round(base_height, 1),
-                "hub_shadow_height": round(hub_shadow_height, 1),
-                "height_correction": round(height_correction, 1),
-                "azimuth_diff": abs(int(shadow_azimuth) - int(azimuth.degrees)),
-                "shadow_azimuth": round(shadow_azimuth, 1),
-                "azimuth": round(azimuth.degrees, 1),
-                "shadow_length": round(shadow_length, 1),
-                "altitude": round(altitude.degrees, 1),
-                "base_latitude": round(base_latitude, 6),
-                "base_longitude": round(base_longitude, 6),
-                "hub_latitude": round(hub_latitude, 6),
-                "hub_longitude": round(hub_longitude, 6),
-                "photo_file": nearest_photo.photo_file,
+        turbine_metadata = turbine_list[detection.turbine_index]
+        turbine_list[detection.turbine_index] = turbine_metadata | {
+            "actual_hub_height": turbine_metadata["actual_hub_height"],
+            "estimated_hub_height": estimated_hub_height,
+            "hub_height_diff": estimated_hub_height - turbine_metadata["actual_hub_height"],
+            "shadow_height": round(shadow_height, 1),
+            "base_height": round(base_height, 1),
+            "hub_shadow_height": round(hub_shadow_height, 1),
+            "height_correction": round(height_correction, 1),
+            "azimuth_diff": detection.azimuth_diff,
+            "shadow_azimuth": round(detection.shadow_azimuth, 1),
+            "azimuth": round(detection.azimuth, 1),
+            "shadow_length": round(detection.shadow_length, 1),
+            "altitude": round(detection.altitude, 1),
+            "base_latitude": round(base_latitude, 6),
+            "base_longitude": round(base_longitude, 6),
+            "hub_latitude": round(hub_latitude, 6),
+            "hub_longitude": round(hub_longitude, 6),
+            "photo_file": detection.photo_file,
+        }
+        if uncertainty:
+            turbine_list[detection.turbine_index] |= {
+                "base_x": detection.base_x,
+                "base_y": detection.base_y,
+                "base_box_width": detection.base_box_width,
+                "base_box_height": detection.base_box_height,
+                "base_confidence": detection.base_confidence,
+                "hub_x": detection.hub_x,
+                "hub_y": detection.hub_y,
+                "hub_box_width": detection.hub_box_width,
+                "hub_box_height": detection.hub_box_height,
+                "hub_confidence": detection.hub_confidence,
+                "image_width": detection.max_size * detection.resolution,
+                "altitude_rate": detection.altitude_rate,
             }
+    # Record the photos and elevation tiles used for each turbine
+    tile_positions = elevation_interpolator.assign_tiles(
+        np.concatenate([detections.point_x, detections.hub_point_x]),
+        np.concatenate([detections.point_y, detections.hub_point_y]),
+    )
+    tile_files = elevation_interpolator.metadata.FICHERO.to_numpy()[tile_positions]
+    dependencies = {
+        detection["turbine_index"]: [photo_source_path] for detection in detection_list
+    }
+    dependencies |= {
+        turbine_index: [
+            photo_source_path,
+            f"data/digital_elevation/files/{base_file}",
+            f"data/digital_elevation/files/{hub_file}",
+        ]
+        for turbine_index, base_file, hub_file in zip(
+            detections.turbine_index,
+            tile_files[: len(detections)],
+            tile_files[len(detections) :],
+        )
+    }
+    missing_tiles |= {
+        turbine_index: sorted({base_file, hub_file} & elevation_interpolator.missing_files)
+        for turbine_index, base_file, hub_file in zip(
+            detections.turbine_index,
+            tile_files[: len(detections)],
+            tile_files[len(detections) :],
         )
-    if len(elevation_interpolator.missing_list) > 0:
-        pd.Series(sorted(set(elevation_interpolator.missing_list))).to_csv(
-            f"data/digital_elevation/{run_name}_missing_files.csv"
+    }
+    for turbine_index, (turbine_key, turbine_inputs) in changed_turbines.items():
+        manifest.record(
+            turbine_key,
+            turbine_inputs,
+            dependencies=dependencies.get(turbine_index, []),
+            data={
+                "turbine": turbine_list[turbine_index],
+                "missing_files": missing_tiles.get(turbine_index, []),
+            },
         )
-    print(r"Saved list of missing files\n", elevation_interpolator.missing_list)
+    manifest.save()
 
-    turbines = pd.DataFrame(turbine_list).assign(
-        missing_labels=lambda x: x.num_bases.eq(0) | x.num_hub_shadows.eq(0),
-        multiple_labels=lambda x: (x.num_bases + x.num_hub_shadows).gt(2) & ~x.missing_labels,
-        azimuth_mismatch=lambda x: x.azimuth_diff.gt(10) & ~x.multiple_labels,
-        good_estimate=lambda x: (
-            ~x[["missing_labels", "multiple_labels", "azimuth_mismatch"]].any(axis=1)
-        ),
-    )
-    site_results = (
-        turbines[turbines.good_estimate]
-        .groupby("site")
-        .agg(
-            {
-                "actual_hub_height": "mean",
-                "estimated_hub_height": "mean",
-                "hub_height_diff": "mean",
-                "altitude": "count",
-            }
+    print(f"Elevation cache: {elevation_interpolator.cache_info()}")
+    order = sorted(range(len(turbine_keys)), key=turbine_keys.__getitem__)
+    missing_list = sorted(set().union(*missing_tiles.values()))
+    return [turbine_list[i] for i in order], [turbine_keys[i] for i in order], missing_list
+
+
+def save_missing_files(run_name, missing_list):
+    """Save the missing elevation tiles for a run, removing the list from earlier runs if none."""
+    path = Path(f"data/digital_elevation/{run_name}_missing_files.csv")
+    if len(missing_list) > 0:
+        pd.Series(sorted(set(missing_list))).to_csv(path)
+    else:
+        path.unlink(missing_ok=True)
+    print(r"Saved list of missing files\n", missing_list)
+
+
+def report_results(run_name, turbines, uncertainty_draws=0):
+    """Save turbine and site predictions, a histogram of errors and the p-values for a run."""
+    with profiler.stage("estimate_hub_height.report"):
+        turbines = turbines.assign(
+            missing_labels=lambda x: x.num_bases.eq(0) | x.num_hub_shadows.eq(0),
+            multiple_labels=lambda x: (x.num_bases + x.num_hub_shadows).gt(2) & ~x.missing_labels,
+            azimuth_mismatch=lambda x: x.azimuth_diff.gt(10) & ~x.multiple_labels,
+            good_estimate=lambda x: (
+                ~x[["missing_labels", "multiple_labels", "azimuth_mismatch"]].any(axis=1)
+            ),
         )
-        .round(1)
-        .rename(columns={"altitude": "valid_estimates"})
-        .join(
-            turbines[~turbines.good_estimate]
+        site_results = (
+            turbines[turbines.good_estimate]
             .groupby("site")
-            .agg({"missing_labels": "sum", "multiple_labels": "sum", "azimuth_mismatch": "sum"}),
-            how="outer",
+            .agg(
+                {
+                    "actual_hub_height": "mean",
+                    "estimated_hub_height": "mean",
+                    "hub_height_diff": "mean",
+                    "altitude": "count",
+                }
+            )
+            .round(1)
+            .rename(columns={"altitude": "valid_estimates"})
+            .join(
+                turbines[~turbines.good_estimate]
+                .groupby("site")
+                .agg(
+                    {"missing_labels": "sum", "multiple_labels": "sum", "azimuth_mismatch": "sum"}
+                ),
+                how="outer",
+            )
+            .assign(num_turbines=lambda x: x.iloc[:, -4:].sum(axis=1))
+        )
+        if uncertainty_draws > 0:
+            with profiler.stage("estimate_hub_height.uncertainty"):
+                turbine_intervals, site_intervals = uncertainty.hub_height_intervals(
+                    turbines[turbines.good_estimate], uncertainty_draws
+                )
+            turbines = turbines.join(turbine_intervals)
+            site_results = site_results.join(site_intervals)
+        turbines.to_csv(f"data/{run_name}_turbine_predictions.csv", index=False)
+        site_results.to_csv(f"data/{run_name}_site_predictions.csv")
+
+        # Plot histogram of hub height errors, using bins of 2m width
+        fig, ax = plt.subplots(figsize=(6, 4))
+        bins = range(
+            (round(site_results.hub_height_diff.min() / 2) * 2) - 1,
+            (round(site_results.hub_height_diff.max() / 2) * 2) + 3,
+            2,
         )
-        .assign(num_turbines=lambda x: x.iloc[:, -4:].sum(axis=1))
+        site_results.hub_height_diff.plot.hist(bins=bins, ax=ax, label="_remove")
+        ax.set_xlabel(f"Hub height errors in the {run_name}ing set (m)")
+        ax.axvline(-5, color="green", linestyle="dotted", label="Required accuracy of 5m")
+        ax.axvline(5, color="green", linestyle="dotted")
+        fig.tight_layout()
+        ax.legend()
+        fig.savefig(f"data/plots/{run_name}_hub_height_errors.png")
+
+        # Carry out a one sample, two-tailed t-test
+        # Null hypothesis: Error < -5m or Error > 5m
+        _, p_lower = stats.ttest_1samp(
+            site_results.hub_height_diff, -5, nan_policy="omit", alternative="greater"
+        )
+        _, p_upper = stats.ttest_1samp(
+            site_results.hub_height_diff, 5, nan_policy="omit", alternative="less"
+        )
+        p_value = p_lower + p_upper
+        summary = (
+            f"{run_name} P-value: {p_value:.3f}\nP-lower: {p_lower:.3f}\nP-upper: {p_upper:.3f}"
+        )
+        print(summary)
+        print(stats.shapiro(site_results.hub_height_diff.dropna()))
+
+
+def label_file_paths(run_name):
+    """Label files for a run, sorted so that every run and shard sees the same order."""
+    return sorted(Path(f"hub_shadow_model/runs/detect/{run_name}/labels").glob("*"))
+
+
+def assign_shards(label_paths, num_shards):
+    """Return the shard of each label file, keeping the turbines of each site together.
+
+    The largest sites are assigned first, each to the shard with the fewest turbines. The
+    assignment only depends on the label file names, so workers on several machines agree.
+    """
+    sites = pd.Series([re.split(r"_(\d+)_", label_path.name)[0] for label_path in label_paths])
+    site_counts = sites.value_counts().sort_index().sort_values(ascending=False, kind="stable")
+    shard_sizes = np.zeros(num_shards, dtype=int)
+    site_shards = {}
+    for site, count in site_counts.items():
+        shard = int(np.argmin(shard_sizes))
+        site_shards[site] = shard
+        shard_sizes[shard] += count
+    return sites.map(site_shards).to_numpy()
+
+
+def shard_path(run_name, shard, num_shards):
+    return Path(f"data/{run_name}_shards/{shard:03d}_of_{num_shards:03d}")
+
+
+def prepare_shared_data():
+    """Build or update the elevation catalog and photo cache, which shards open read only."""
+    tile_catalog.load_catalog("mdt05")
+    if not photo_store.store_is_current():
+        load_photo_metadata()
+
+
+def init_worker():
+    worker_state["sun_position"] = SunPosition()
+    worker_state["elevation_interpolator"] = interpolators.ElevationInterpolator(
+        build_catalog=False
     )
-    turbines.to_csv(f"data/{run_name}_turbine_predictions.csv", index=False)
-    site_results.to_csv(f"data/{run_name}_site_predictions.csv")
-
-    # Plot histogram of hub height errors, using bins of 2m width
-    fig, ax = plt.subplots(figsize=(6, 4))
-    bins = range(
-        (round(site_results.hub_height_diff.min() / 2) * 2) - 1,
-        (round(site_results.hub_height_diff.max() / 2) * 2) + 3,
-        2,
+
+
+def estimate_shard(run_name, shard, num_shards, prefetch_depth=2, uncertainty_draws=0):
+    """Estimate the turbines in one shard of a run and save a partial turbine table.
+
+    Returns the profiler state of the shard, so that main can include it in the run profile.
+    Set uncertainty_draws to the value that will be passed to merge_shards.
+    Shards can be run in a process pool by main, or on several machines which share the data
+    folder, after prepare_shared_data and followed by merge_shards.
+    """
+    dotenv.load_dotenv(".env")
+    dotenv.load_dotenv(".env.secret")
+    if len(worker_state) == 0:
+        init_worker()
+    elevation_interpolator = worker_state["elevation_interpolator"]
+    elevation_interpolator.prefetch_depth = prefetch_depth
+
+    profiler.reset()
+    label_paths = label_file_paths(run_name)
+    shards = assign_shards(label_paths, num_shards)
+    shard_paths = schedule_turbines(
+        np.array(label_paths, dtype=object)[shards == shard], elevation_interpolator.tile_catalog
     )
-    site_results.hub_height_diff.plot.hist(bins=bins, ax=ax, label="_remove")
-    ax.set_xlabel(f"Hub height errors in the {run_name}ing set (m)")
-    ax.axvline(-5, color="green", linestyle="dotted", label="Required accuracy of 5m")
-    ax.axvline(5, color="green", linestyle="dotted")
-    fig.tight_layout()
-    ax.legend()
-    fig.savefig(f"data/plots/{run_name}_hub_height_errors.png")
-
-    # Carry out a one sample, two-tailed t-test
-    # Null hypothesis: Error < -5m or Error > 5m
-    _, p_lower = stats.ttest_1samp(
-        site_results.hub_height_diff, -5, nan_policy="omit", alternative="greater"
+    turbine_list, turbine_keys, missing_list = estimate_turbines(
+        read_label_files(shard_paths, prefetch_depth),
+        worker_state["sun_position"],
+        elevation_interpolator,
+        f"estimate_hub_height_{run_name}_{shard:03d}_of_{num_shards:03d}",
+        read_only=True,
+        uncertainty=uncertainty_draws > 0,
     )
-    _, p_upper = stats.ttest_1samp(
-        site_results.hub_height_diff, 5, nan_policy="omit", alternative="less"
+
+    path = shard_path(run_name, shard, num_shards)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    pd.DataFrame(turbine_list).assign(label_name=turbine_keys).to_parquet(
+        f"{path}_turbines.parquet", index=False
+    )
+    pd.Series(missing_list, dtype=object).to_csv(
+        f"{path}_missing_files.csv", index=False, header=["missing_file"]
+    )
+    profiler.save(str(path))
+    print(f"Shard {shard + 1} of {num_shards}: {len(turbine_list)} turbines")
+    return profiler.state()
+
+
+def merge_shards(run_name, num_shards, uncertainty_draws=0):
+    """Combine the partial turbine tables of a sharded run, and save the results of the run.
+
+    Turbines are put back in label file order, so the predictions, histogram and p-values are
+    the same as a serial run.
+    """
+    paths = [shard_path(run_name, shard, num_shards) for shard in range(num_shards)]
+    missing_shards = [
+        str(path) for path in paths if not Path(f"{path}_turbines.parquet").exists()
+    ]
+    if len(missing_shards) > 0:
+        raise FileNotFoundError(f"Shards have not been estimated: {', '.join(missing_shards)}")
+
+    turbine_tables = [pd.read_parquet(f"{path}_turbines.parquet") for path in paths]
+    turbines = (
+        pd.concat([table for table in turbine_tables if len(table) > 0], ignore_index=True)
+        .sort_values("label_name", kind="stable")
+        .drop(columns="label_name")
+        .reset_index(drop=True)
+    )
+    missing_list = [
+        missing_file
+        for path in paths
+        for missing_file in pd.read_csv(f"{path}_missing_files.csv").missing_file
+    ]
+    save_missing_files(run_name, missing_list)
+    report_results(run_name, turbines, uncertainty_draws)
+
+
+def schedule_turbines(paths, elevation_catalog):
+    """Order label or image files by elevation tile, then orthophoto sheet, then name.
+
+    Turbines which share tiles are estimated together, so each tile and image is read while the
+    ones before it are used. Files for turbines without metadata are kept at the end.
+    """
+    paths = sorted(paths)
+    files = (
+        pd.Series([Path(path).name for path in paths])
+        .str.extract(r"^(.*?)_(\d+)_")
+        .set_axis(["site", "turbine_num"], axis=1)
+        .assign(turbine_num=lambda x: pd.to_numeric(x.turbine_num), position=range(len(paths)))
+    )
+    turbines = pd.read_csv(
+        "data/turbine_image_metadata.csv",
+        usecols=[
+            "site",
+            "turbine_num",
+            "turbine_corner_x",
+            "turbine_corner_y",
+            "max_size",
+            "resolution",
+        ],
+    ).drop_duplicates(["site", "turbine_num"])
+    sites = pd.read_csv(
+        "data/site_photo_metadata.csv", usecols=["site", "orthophoto_name", "HUSO"]
+    ).drop_duplicates("site")
+    files = files.merge(turbines, how="left").merge(sites, how="left")
+
+    known = files.turbine_corner_x.notna() & files.HUSO.notna()
+    tile_positions = np.full(len(files), np.iinfo(np.int64).max)
+    if known.any():
+        turbine_x, turbine_y = transforms.transform_utm(
+            files.turbine_corner_x[known] + files.max_size[known] * files.resolution[known] / 2,
+            files.turbine_corner_y[known] - files.max_size[known] * files.resolution[known] / 2,
+            files.HUSO[known],
+            "EPSG:25830",
+        )
+        tile_positions[known.to_numpy()] = elevation_catalog.lookup(turbine_x, turbine_y)
+    order = (
+        files.assign(tile_position=tile_positions)
+        .sort_values(["tile_position", "orthophoto_name", "position"], na_position="last")
+        .position.to_numpy()
     )
-    p_value = p_lower + p_upper
-    summary = f"{run_name} P-value: {p_value:.3f}\nP-lower: {p_lower:.3f}\nP-upper: {p_upper:.3f}"
-    print(summary)
-    print(stats.shapiro(site_results.hub_height_diff.dropna()))
-    print(f"Duration: {round(((datetime.now() - start_time).total_seconds() + 61) / 60, 1)} min")
+    return [paths[position] for position in order]
+
+
+def read_label_files(label_paths, prefetch_depth=0):
+    """Generate the name and labels of each YOLOv7 label file, reading ahead in threads."""
+    for label_path, labels in prefetch.prefetch(
+        read_label_file, label_paths, prefetch_depth, "estimate_hub_height.labels"
+    ):
+        yield label_path.name, labels
+
+
+def read_label_file(label_path):
+    return pd.read_csv(label_path, sep=" ", names=detectors.LABEL_COLUMNS)
 
 
 def calculate_coordinates(object_x, object_y, turbine, zone):
+    x_coordinate, y_coordinate = calculate_utm_coordinates(object_x, object_y, turbine)
+    latitude, longitude = transforms.transform_utm(x_coordinate, y_coordinate, zone, "EPSG:4326")
+
+    return latitude, longitude
+
+
+def calculate_utm_coordinates(object_x, object_y, turbine):
+    """Convert relative label positions to coordinates in the UTM zone of the orthophoto.
+
+    Accepts a single turbine row, or a DataFrame of turbines with arrays of label positions.
+    """
     x_coordinate = turbine.turbine_corner_x + (object_x * turbine.resolution * turbine.max_size)
     y_coordinate = turbine.turbine_corner_y - (object_y * turbine.resolution * turbine.max_size)
 
-    transformer = Transformer.from_crs(f"EPSG:258{zone}", "EPSG:4326")
-    latitude, longitude = transformer.transform(x_coordinate, y_coordinate)
-
-    return latitude, longitude
+    return x_coordinate, y_coordinate
 
 
 if __name__ == "__main__":
-    # main("test")
-    main("train")
+    parser = argparse.ArgumentParser(description=main.__doc__.splitlines()[0])
+    parser.add_argument("run_name", nargs="?", default="train")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--uncertainty-draws", type=int, default=0)
+    parser.add_argument("--prefetch-depth", type=int, default=2)
+    parser.add_argument("--prepare", action="store_true", help="Prepare data before shards")
+    parser.add_argument("--shard", type=int, help="Estimate one shard, for multiple machines")
+    parser.add_argument("--num-shards", type=int)
+    parser.add_argument("--merge", action="store_true", help="Merge shards from --num-shards")
+    args = parser.parse_args()
+    if (args.shard is not None or args.merge) and args.num_shards is None:
+        parser.error("--shard and --merge need --num-shards")
+    if args.num_shards is not None and args.num_shards < 1:
+        parser.error("--num-shards must be at least 1")
+    if args.shard is not None and not 0 <= args.shard < args.num_shards:
+        parser.error("--shard must be between 0 and --num-shards - 1")
+    if args.prepare:
+        prepare_shared_data()
+    elif args.shard is not None:
+        estimate_shard(
+            args.run_name,
+            args.shard,
+            args.num_shards,
+            args.prefetch_depth,
+            args.uncertainty_draws,
+        )
+    elif args.merge:
+        merge_shards(args.run_name, args.num_shards, args.uncertainty_draws)
+    else:
+        main(
+            args.run_name,
+            uncertainty_draws=args.uncertainty_draws,
+            workers=args.workers,
+            prefetch_depth=args.prefetch_depth,
+        )
@@ -1,4 +1,6 @@
-import geopandas as gpd
+import collections
+import time
+
 import numpy as np
 import pandas as pd
 from pyproj import Transformer
@@ -6,38 +8,120 @@ from osgeo import gdal  # noqa
 from scipy.interpolate import RegularGridInterpolator
 from shapely.geometry import Point
 
+from common.profiling import profiler
+from evaluate import elevation_tiles, prefetch
+from prep_images import tile_catalog
+
 
 class ElevationInterpolator:
     metadata = None
     filename = None
     interpolator = None
     transformer_to_30n = Transformer.from_crs(f"EPSG:4326", f"EPSG:25830")
-    missing_list = []
-
-    def __init__(self):
-        # Load elevation metadata from Informacion_auxiliar_LIDAR_2_cobertura.zip
-        self.metadata = gpd.read_file(
-            "data/digital_elevation/coverage/MDT05.shp"  # noqa
-        ).set_geometry(
-            "geometry", drop=True
-        )
+
+    def __init__(
+        self,
+        cache_bytes=2 * 1024**3,
+        window_points=32,
+        window_padding=2,
+        prefetch_depth=2,
+        build_catalog=True,
+    ):
+        """Interpolate elevations, keeping recently used tiles in an LRU cache.
+
+        Tiles are evicted once their total size exceeds cache_bytes. The most recently used tile
+        is always kept, even if it is larger than the budget. In get_elevations, tiles with fewer
+        than window_points points which are not already cached are read as a small window,
+        padded by window_padding cells, rather than loading the whole tile. Up to prefetch_depth
+        tiles are read in background threads while earlier tiles are interpolated. If
+        build_catalog is False, the tile catalog is opened without being checked or rebuilt.
+        """
+        # Elevation tiles from MDT05.shp in Informacion_auxiliar_LIDAR_2_cobertura.zip, looked up
+        # in a prebuilt grid catalog
+        self.tile_catalog = tile_catalog.load_catalog("mdt05", build=build_catalog)
+        self.metadata = self.tile_catalog.metadata
+        self.cache_bytes = cache_bytes
+        self.window_points = window_points
+        self.window_padding = window_padding
+        self.prefetch_depth = prefetch_depth
+        self.cached_bytes = 0
+        self.interpolators = collections.OrderedDict()
+        self.missing_files = set()
+        self.missing_list = []
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.window_reads = 0
+
+    def assign_tiles(self, x_coordinates, y_coordinates):
+        """Return the metadata row of the tile containing each EPSG:25830 point in one query.
+
+        Where tiles overlap the first tile in the metadata is used. Points outside every tile
+        are assigned -1.
+        """
+        return self.tile_catalog.lookup(x_coordinates, y_coordinates)
 
     def check_cache(self, point):
-        """Find the nearest Digital Elevation tile and load into cache if it has changed."""
-        elevation_tiles = (
-            self.metadata[self.metadata.contains(point)]
-            .assign(distance_to_centroid=lambda x: x.distance(point))
-            .sort_values("distance_to_centroid")
-        )
-        if len(elevation_tiles) == 0:
+        """Find the Digital Elevation tile and load into cache if it has changed."""
+        tile_position = self.assign_tiles([point.x], [point.y])[0]
+        if tile_position < 0:
             raise ValueError("Elevation tile could not be found in metadata")
 
-        new_filename = elevation_tiles.FICHERO.iloc[0]
+        new_filename = self.metadata.FICHERO.iloc[tile_position]
         if new_filename != self.filename:
-            self.load_elevation_interpolator(new_filename)
+            self.interpolator = self.get_interpolator(new_filename)
+            self.filename = new_filename
+
+    def get_interpolator(self, filename, load=None):
+        """Return the interpolator for a tile from the cache, or None if the tile is missing.
+
+        Tiles which are not cached are loaded with load(filename), by default
+        load_elevation_interpolator.
+        """
+        if filename in self.interpolators:
+            self.hits += 1
+            profiler.count("elevation_cache.hits")
+            self.interpolators.move_to_end(filename)
+            return self.interpolators[filename]
+        if filename in self.missing_files:
+            self.hits += 1
+            profiler.count("elevation_cache.hits")
+            return None
+
+        self.misses += 1
+        profiler.count("elevation_cache.misses")
+        interpolator = (load or self.load_elevation_interpolator)(filename)
+        if interpolator is None:
+            self.missing_files.add(filename)
+            self.missing_list.append(filename)
+            return None
+
+        self.interpolators[filename] = interpolator
+        self.cached_bytes += interpolator.values.nbytes
+        while self.cached_bytes > self.cache_bytes and len(self.interpolators) > 1:
+            _, evicted = self.interpolators.popitem(last=False)
+            self.cached_bytes -= evicted.values.nbytes
+            self.evictions += 1
+            profiler.count("elevation_cache.evictions")
+        return interpolator
+
+    def cache_info(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "window_reads": self.window_reads,
+            "cached_tiles": len(self.interpolators),
+            "cached_bytes": self.cached_bytes,
+            "missing_files": len(self.missing_files),
+        }
 
     def get_elevation(self, latitude, longitude):
-        point = Point(self.transformer_to_30n.transform(latitude, longitude))
+        return self.get_elevation_xy(*self.transformer_to_30n.transform(latitude, longitude))
+
+    def get_elevation_xy(self, x_coordinate, y_coordinate):
+        """Elevation at a point that is already projected to EPSG:25830."""
+        point = Point(x_coordinate, y_coordinate)
         self.check_cache(point)
 
         if self.interpolator is None:
@@ -46,46 +130,135 @@ class ElevationInterpolator:
         elevation = self.interpolator([point.y, point.x])[0]
         return elevation
 
+    def get_elevations(self, latitudes, longitudes):
+        x_coordinates, y_coordinates = self.transformer_to_30n.transform(
+            np.asarray(latitudes, dtype=float), np.asarray(longitudes, dtype=float)
+        )
+        return self.get_elevations_xy(x_coordinates, y_coordinates)
+
+    def get_elevations_xy(self, x_coordinates, y_coordinates):
+        """Elevations for arrays of EPSG:25830 points, loading each tile once.
+
+        Points are grouped by tile and interpolated with one call per tile. Points in missing
+        tiles are NaN.
+        """
+        x_coordinates = np.asarray(x_coordinates, dtype=float)
+        y_coordinates = np.asarray(y_coordinates, dtype=float)
+        elevations = np.full(len(x_coordinates), np.nan)
+        if len(x_coordinates) == 0:
+            return elevations
+
+        tile_positions = self.assign_tiles(x_coordinates, y_coordinates)
+        if (tile_positions < 0).any():
+            raise ValueError("Elevation tile could not be found in metadata")
+
+        filenames = self.metadata.FICHERO.to_numpy()[tile_positions]
+        tile_points = pd.Series(np.arange(len(filenames))).groupby(filenames).indices
+
+        # Use cached tiles first, so that they are not evicted by new tiles. The other tiles are
+        # read in order of name, which keeps neighbouring tiles together
+        cached_files = [
+            filename
+            for filename in pd.unique(filenames)
+            if filename in self.interpolators or filename in self.missing_files
+        ]
+        for filename in cached_files:
+            self.interpolate_tile(
+                elevations, tile_points[filename], x_coordinates, y_coordinates, filename, None
+            )
+
+        # Reads are timed in the prefetch threads, and recorded as profiler stages here
+        def read(filename):
+            points = tile_points[filename]
+            wall_start, cpu_start = time.perf_counter(), time.thread_time()
+            if len(points) < self.window_points:
+                stage = "elevation.load_window"
+                tile_data = read_window(
+                    filename, x_coordinates[points], y_coordinates[points], self.window_padding
+                )
+            else:
+                stage = "elevation.load_tile"
+                tile_data = read_tile(filename)
+            timing = (stage, time.perf_counter() - wall_start, time.thread_time() - cpu_start)
+            return tile_data, timing
+
+        new_files = sorted(set(tile_points) - set(cached_files))
+        for filename, (tile_data, timing) in prefetch.prefetch(
+            read, new_files, self.prefetch_depth, "elevation.tiles"
+        ):
+            profiler.add_stage(*timing)
+            self.interpolate_tile(
+                elevations, tile_points[filename], x_coordinates, y_coordinates, filename, tile_data
+            )
+        return elevations
+
+    def interpolate_tile(
+        self, elevations, points, x_coordinates, y_coordinates, filename, tile_data
+    ):
+        """Interpolate the points in one tile, using a window if there are few points.
+
+        tile_data is the window or tile returned by read, or None if the tile is missing. It is
+        not used if the tile is already cached.
+        """
+        if (
+            len(points) < self.window_points
+            and filename not in self.interpolators
+            and filename not in self.missing_files
+        ):
+            interpolator = self.window_interpolator(filename, tile_data)
+        else:
+            interpolator = self.get_interpolator(
+                filename, lambda filename: self.tile_interpolator(filename, tile_data)
+            )
+        if interpolator is not None:
+            elevations[points] = interpolator(
+                np.column_stack([y_coordinates[points], x_coordinates[points]])
+            )
+
     def load_elevation_interpolator(self, filename):
-        """Load RegularGridInterpolator from ascii digital elevation file."""
-        try:
-            elevation_data = pd.read_csv(
-                f"data/digital_elevation/files/{filename}",
-                skiprows=6,
-                skipfooter=1,
-                header=None,
-                sep=" ",
-                engine="python",
-            ).iloc[:, :-1]
-            metadata = pd.read_csv(
-                f"data/digital_elevation/files/{filename}",
-                header=None,
-                skipfooter=len(elevation_data) + 1,
-                index_col=0,
-                sep=" ",
-                engine="python",
-            ).T.iloc[0]
-        except FileNotFoundError:
+        """Load RegularGridInterpolator from a memory mapped digital elevation tile."""
+        with profiler.stage("elevation.load_tile"):
+            tile_data = read_tile(filename)
+        return self.tile_interpolator(filename, tile_data)
+
+    def tile_interpolator(self, filename, tile_data):
+        if tile_data is None:
             print(f"Could not load {filename}, please download and add to dataset.")
-            self.interpolator = None
-            self.filename = filename
+            return None
+
+        # Interpolate elevation. Rows are stored from south to north, so both axes ascend.
+        print(f"Loaded {filename}")
+        return RegularGridInterpolator(tile_data[:2], tile_data[2])
+
+    def window_interpolator(self, filename, window_data):
+        if window_data is None:
+            print(f"Could not load {filename}, please download and add to dataset.")
+            self.missing_files.add(filename)
             self.missing_list.append(filename)
-            return
+            return None
 
-        # Replace null values
-        elevation_data[elevation_data == metadata.NODATA_VALUE] = np.nan
+        self.window_reads += 1
+        profiler.count("elevation_cache.window_reads")
+        return RegularGridInterpolator(window_data[:2], window_data[2])
 
-        # Interpolate elevation. Note that 0, 0 is the NW corner of the data.
-        x_values = np.linspace(
-            metadata.XLLCENTER,
-            metadata.XLLCENTER + (metadata.NCOLS - 1) * metadata.CELLSIZE,
-            metadata.NCOLS,
-        )
-        y_values = np.linspace(
-            metadata.YLLCENTER + (metadata.NROWS - 1) * metadata.CELLSIZE,
-            metadata.YLLCENTER,
-            metadata.NROWS,
+
+def read_tile(filename):
+    """Ascending y and x cell centres and elevations of a tile, or None if it is missing.
+
+    Does not use the profiler, so it can run in a prefetch thread.
+    """
+    try:
+        _, y_values, x_values, elevation_data = elevation_tiles.load_elevation_tile(filename)
+    except FileNotFoundError:
+        return None
+    return y_values, x_values, elevation_data
+
+
+def read_window(filename, x_coordinates, y_coordinates, padding):
+    """Ascending y and x cell centres and elevations around the points, or None if missing."""
+    try:
+        return elevation_tiles.read_elevation_window(
+            filename, x_coordinates, y_coordinates, padding
         )
-        self.interpolator = RegularGridInterpolator((y_values, x_values), elevation_data.to_numpy())
-        self.filename = filename
-        print(f"Loaded {filename}")
+    except FileNotFoundError:
+        return None
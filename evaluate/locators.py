@@ -0,0 +1,73 @@
+import numpy as np
+from scipy.spatial import cKDTree
+from shapely.geometry import Point
+
+
+class PhotoLocator:
+    """Find the nearest aerial photo using a KD-tree over the photo centroids (EPSG:25830)."""
+
+    def __init__(self, photo_table, max_distance=3100):
+        self.photo_table = photo_table
+        self.max_distance = max_distance
+        self.coordinates = np.column_stack([photo_table.x, photo_table.y])
+        self.tree = cKDTree(self.coordinates)
+
+        # Point.buffer() approximates the circle with 64 segments, so points between the
+        # inscribed radius and max_distance need to be checked against the polygon itself
+        self.inner_distance = max_distance * np.cos(np.pi / 64) * (1 - 1e-9)
+
+    def query(self, x, y, k=1):
+        """Return distances and row positions of the k nearest photos within max_distance.
+
+        Missing neighbours have a distance of inf and a position of -1.
+        """
+        points = np.column_stack([np.atleast_1d(x), np.atleast_1d(y)]).astype(float)
+        distances, positions = self.tree.query(
+            points, k=k, distance_upper_bound=self.max_distance
+        )
+        distances = distances.reshape(len(points), k)
+        positions = positions.reshape(len(points), k)
+
+        positions = np.where(np.isfinite(distances), positions, -1)
+        border = np.isfinite(distances) & (distances > self.inner_distance)
+        for point_num, neighbour_num in zip(*np.nonzero(border)):
+            point = Point(points[point_num])
+            photo = Point(self.coordinates[positions[point_num, neighbour_num]])
+            if not photo.within(point.buffer(self.max_distance)):
+                distances[point_num, neighbour_num] = np.inf
+                positions[point_num, neighbour_num] = -1
+        return distances, positions
+
+    def nearest(self, x, y):
+        """Return the row position of the nearest photo to each point, or -1 if none is found.
+
+        Photos are filtered and ranked in the same way as sorting the photo table by distance
+        within a 3100m buffer. Ties are broken by row position.
+        """
+        points = np.column_stack([np.atleast_1d(x), np.atleast_1d(y)]).astype(float)
+        distances, positions = self.tree.query(
+            points, k=1, distance_upper_bound=self.max_distance
+        )
+        nearest_positions = np.full(len(points), -1, dtype=np.int64)
+
+        # Resolve ties by selecting the first photo at the nearest distance
+        inside = distances <= self.inner_distance
+        if inside.any():
+            candidates = self.tree.query_ball_point(
+                points[inside], r=distances[inside] * (1 + 1e-12)
+            )
+            nearest_positions[inside] = [min(candidate) for candidate in candidates]
+
+        # Near the edge of the buffer, rank all candidates inside the polygon
+        for point_num in np.nonzero(np.isfinite(distances) & ~inside)[0]:
+            point = Point(points[point_num])
+            area_around_point = point.buffer(self.max_distance)
+            candidates = [
+                (np.hypot(*(self.coordinates[candidate] - points[point_num])), candidate)
+                for candidate in self.tree.query_ball_point(points[point_num], self.max_distance)
+                if Point(self.coordinates[candidate]).within(area_around_point)
+            ]
+            if len(candidates) > 0:
+                nearest_positions[point_num] = min(candidates)[1]
+        return nearest_positions
+
@@ -0,0 +1,46 @@
+import collections
+import concurrent.futures
+import itertools
+
+from common.profiling import profiler
+
+
+def prefetch(load, items, depth=2, name="prefetch"):
+    """Generate (item, load(item)) in order, loading up to depth items ahead in a thread pool.
+
+    Loads run while the caller works on earlier items, so they should release the GIL (file
+    reads, GDAL, numpy and the pandas parser do) and must not use the profiler. Time spent
+    waiting for a load to finish is recorded as the profiler stage {name}.stall, with a count of
+    {name}.stalls where the load was not ready. If depth is 0, items are loaded when needed.
+    """
+    items = iter(items)
+    if depth <= 0:
+        for item in items:
+            with profiler.stage(f"{name}.stall"):
+                result = load(item)
+            profiler.count(f"{name}.stalls")
+            yield item, result
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=depth) as executor:
+        futures = collections.deque(
+            (item, executor.submit(load, item)) for item in itertools.islice(items, depth)
+        )
+        while len(futures) > 0:
+            item, future = futures.popleft()
+            if not future.done():
+                profiler.count(f"{name}.stalls")
+            with profiler.stage(f"{name}.stall"):
+                result = future.result()
+            for next_item in itertools.islice(items, 1):
+                futures.append((next_item, executor.submit(load, next_item)))
+            yield item, result
+
+
+def stall_seconds():
+    """Total time spent waiting for prefetched items, for each prefetch name."""
+    return {
+        name[: -len(".stall")]: values["wall_seconds"]
+        for name, values in profiler.stages.items()
+        if name.endswith(".stall")
+    }
@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+from skyfield import api as skyfield_api
+
+
+class SunPosition:
+    """Calculate the apparent position of the sun, loading the timescale and ephemeris once."""
+
+    def __init__(self, ephemeris_file="de421.bsp"):
+        self.timescale = skyfield_api.load.timescale()
+        ephemeris = skyfield_api.load(ephemeris_file)
+        self.earth, self.sun = ephemeris["earth"], ephemeris["sun"]
+
+    def altaz(self, latitudes, longitudes, timestamps):
+        """Return arrays of sun altitude and azimuth in degrees for each observer and time."""
+        latitudes = np.asarray(latitudes, dtype=float)
+        if latitudes.size == 0:
+            return np.array([]), np.array([])
+
+        timestamps = pd.DatetimeIndex(timestamps).tz_convert("UTC")
+        time = self.timescale.utc(
+            timestamps.year.to_numpy(),
+            timestamps.month.to_numpy(),
+            timestamps.day.to_numpy(),
+            timestamps.hour.to_numpy(),
+            timestamps.minute.to_numpy(),
+            timestamps.second.to_numpy() + timestamps.microsecond.to_numpy() / 1e6,
+        )
+        observer = self.earth + skyfield_api.wgs84.latlon(
+            latitude_degrees=latitudes, longitude_degrees=np.asarray(longitudes, dtype=float)
+        )
+        altitude, azimuth, _ = observer.at(time).observe(self.sun).apparent().altaz()
+        return altitude.degrees, azimuth.degrees
@@ -0,0 +1,44 @@
+import functools
+
+import numpy as np
+from pyproj import Transformer
+
+
+@functools.lru_cache(maxsize=None)
+def get_transformer(source_crs, target_crs):
+    """Return a Transformer, so that proj is only set up once for each pair of projections."""
+    return Transformer.from_crs(source_crs, target_crs)
+
+
+def utm_crs(zone):
+    """ETRS89 UTM projection for zones 29, 30 and 31."""
+    return f"EPSG:258{int(zone)}"
+
+
+def transform_utm(x_coordinates, y_coordinates, zones, target_crs):
+    """Transform ETRS89 UTM coordinates from one or more zones into target_crs.
+
+    Coordinates are transformed as arrays, one call per zone. When the target is the same UTM
+    zone they are returned unchanged, and other ETRS89 UTM zones are projected directly rather
+    than through WGS84. The axis order follows target_crs, so EPSG:4326 returns latitude and
+    longitude.
+    """
+    scalar = np.ndim(x_coordinates) == 0
+    x_coordinates = np.atleast_1d(np.asarray(x_coordinates, dtype=float))
+    y_coordinates = np.atleast_1d(np.asarray(y_coordinates, dtype=float))
+    zones = np.broadcast_to(np.asarray(zones).astype(int), x_coordinates.shape)
+
+    first = np.full(x_coordinates.shape, np.nan)
+    second = np.full(x_coordinates.shape, np.nan)
+    for zone in np.unique(zones):
+        in_zone = zones == zone
+        if utm_crs(zone) == target_crs:
+            first[in_zone], second[in_zone] = x_coordinates[in_zone], y_coordinates[in_zone]
+        else:
+            first[in_zone], second[in_zone] = get_transformer(utm_crs(zone), target_crs).transform(
+                x_coordinates[in_zone], y_coordinates[in_zone]
+            )
+
+    if scalar:
+        return first[0], second[0]
+    return first, second
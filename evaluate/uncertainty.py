@@ -0,0 +1,150 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# Relative label centres, box sizes and confidences, the width of the turbine image in metres
+# and the change in sun altitude per second at the photo time
+UNCERTAINTY_COLUMNS = [
+    "base_x",
+    "base_y",
+    "base_box_width",
+    "base_box_height",
+    "base_confidence",
+    "hub_x",
+    "hub_y",
+    "hub_box_width",
+    "hub_box_height",
+    "hub_confidence",
+    "image_width",
+    "altitude",
+    "altitude_rate",
+    "estimated_hub_height",
+]
+
+
+def hub_height_intervals(
+    turbines,
+    num_draws=10000,
+    interval=0.95,
+    label_sigma=0.1,
+    timestamp_sigma=60,
+    dem_sigma=1.0,
+    seed=0,
+    max_chunk_values=2**22,
+):
+    """Monte-Carlo confidence intervals for the hub height of each turbine and site.
+
+    Label centres are jittered by label_sigma of the box size, divided by the label confidence.
+    Photo times are jittered by timestamp_sigma seconds, shared by every turbine in a photo,
+    and the base and hub shadow elevations by dem_sigma metres each. Each draw is the change in
+    the shadow height formula, added to estimated_hub_height.
+
+    All draws for a chunk of turbines are calculated as arrays of turbines * num_draws, with
+    chunks of about max_chunk_values. Returns turbine intervals with the index of turbines,
+    and intervals for the mean estimate of each site.
+    """
+    # Labels without a confidence, such as manual labels, are treated as certain
+    turbines = (
+        turbines.fillna({"base_confidence": 1, "hub_confidence": 1})
+        .dropna(subset=UNCERTAINTY_COLUMNS)
+        .sort_values("photo_file")
+    )
+    rng = np.random.default_rng(seed)
+    lower_quantile, upper_quantile = (1 - interval) / 2, (1 + interval) / 2
+    site_codes, sites = pd.factorize(turbines.site)
+    site_sums = np.zeros((len(sites), num_draws))
+    site_counts = np.bincount(site_codes, minlength=len(sites))
+
+    # Chunks end at the last turbine of a photo, so that photos share their time offsets
+    photo_codes = pd.factorize(turbines.photo_file)[0]
+    photo_ends = np.flatnonzero(np.diff(photo_codes, append=-1)) + 1
+    chunk_rows = max(max_chunk_values // num_draws, 1)
+    turbine_intervals = []
+    chunk_start = 0
+    while chunk_start < len(turbines):
+        last_photo = np.searchsorted(photo_ends, chunk_start + chunk_rows, side="right") - 1
+        chunk_end = photo_ends[last_photo] if last_photo >= 0 else 0
+        if chunk_end <= chunk_start:
+            chunk_end = photo_ends[np.searchsorted(photo_ends, chunk_start, side="right")]
+        chunk = turbines.iloc[chunk_start:chunk_end]
+        draws = sample_hub_heights(
+            chunk,
+            photo_codes[chunk_start:chunk_end],
+            num_draws,
+            rng,
+            label_sigma,
+            timestamp_sigma,
+            dem_sigma,
+        )
+
+        lower, upper = np.quantile(draws, [lower_quantile, upper_quantile], axis=1)
+        turbine_intervals.append(
+            pd.DataFrame(
+                {
+                    "hub_height_std": draws.std(axis=1),
+                    "hub_height_lower": lower,
+                    "hub_height_upper": upper,
+                },
+                index=chunk.index,
+            )
+        )
+        site_matrix = sparse.csr_matrix(
+            (
+                np.ones(len(chunk)),
+                (site_codes[chunk_start:chunk_end], np.arange(len(chunk))),
+            ),
+            shape=(len(sites), len(chunk)),
+        )
+        site_sums += site_matrix @ draws
+        chunk_start = chunk_end
+
+    site_draws = site_sums / np.maximum(site_counts, 1)[:, None]
+    site_lower, site_upper = np.quantile(site_draws, [lower_quantile, upper_quantile], axis=1)
+    site_intervals = pd.DataFrame(
+        {
+            "estimated_hub_height_lower": site_lower,
+            "estimated_hub_height_upper": site_upper,
+        },
+        index=pd.Index(sites, name="site"),
+    )
+    if len(turbine_intervals) == 0:
+        turbine_intervals = pd.DataFrame(
+            columns=["hub_height_std", "hub_height_lower", "hub_height_upper"], dtype=float
+        )
+    else:
+        turbine_intervals = pd.concat(turbine_intervals)
+    return turbine_intervals.round(1), site_intervals.round(1)
+
+
+def sample_hub_heights(
+    turbines, photo_codes, num_draws, rng, label_sigma, timestamp_sigma, dem_sigma
+):
+    """Return an array of hub height draws, with a row for each turbine."""
+
+    def column(name):
+        return turbines[name].to_numpy(dtype=float)[:, None]
+
+    def jitter(values, sigma):
+        return values + rng.standard_normal((len(turbines), num_draws)) * sigma
+
+    # Low confidence labels are clipped, so that they do not dominate the interval
+    base_confidence = np.clip(column("base_confidence"), 0.05, 1)
+    hub_confidence = np.clip(column("hub_confidence"), 0.05, 1)
+    base_x = jitter(column("base_x"), label_sigma * column("base_box_width") / base_confidence)
+    base_y = jitter(column("base_y"), label_sigma * column("base_box_height") / base_confidence)
+    hub_x = jitter(column("hub_x"), label_sigma * column("hub_box_width") / hub_confidence)
+    hub_y = jitter(column("hub_y"), label_sigma * column("hub_box_height") / hub_confidence)
+    shadow_length = np.hypot(base_x - hub_x, base_y - hub_y) * column("image_width")
+
+    photos, photo_positions = np.unique(photo_codes, return_inverse=True)
+    time_offsets = rng.normal(0, timestamp_sigma, (len(photos), num_draws))[photo_positions]
+    altitude = column("altitude") + column("altitude_rate") * time_offsets
+    correction_error = rng.normal(0, dem_sigma * np.sqrt(2), (len(turbines), num_draws))
+    shadow_height = np.tan(np.radians(altitude)) * shadow_length - correction_error
+
+    nominal_height = (
+        np.tan(np.radians(column("altitude")))
+        * np.hypot(column("base_x") - column("hub_x"), column("base_y") - column("hub_y"))
+        * column("image_width")
+    )
+    return column("estimated_hub_height") + shadow_height - nominal_height
@@ -1,48 +1,118 @@
+import concurrent.futures
+import functools
+import os
+
 import dotenv
 import pandas as pd
 from osgeo import gdal  # noqa
 
+from common.manifest import Manifest
+from common.profiling import profiler
+
+# Clip each image to 2km * 2km, centered on the wind site
+CLIP_WIDTH = 2000
+
+# GDAL driver, file suffix and creation options for each output format. VRTs reference pixels
+# in the source ECW, while COGs are tiled and compressed losslessly with overviews. Both keep
+# the georeferencing, so turbine crops can read just the pixels they need.
+OUTPUT_FORMATS = {
+    "png": ("PNG", ".png", []),
+    "vrt": ("VRT", ".vrt", []),
+    "cog": ("COG", ".tif", ["COMPRESS=DEFLATE", "PREDICTOR=YES", "OVERVIEWS=AUTO"]),
+}
 
-def main():
+
+def main(workers=None, output_format="png"):
     dotenv.load_dotenv(".env")
     dotenv.load_dotenv(".env.secret")
 
-    # Clip each image to 2km * 2km, centered on the wind site
-    clip_width = 2000
-
     # Load site photo metadata
     site_metadata = pd.read_csv("data/site_photo_metadata.csv")
 
-    orthophoto_list = []
-    for _, site in site_metadata.iterrows():
-        print(f"Cropping {site.site}")
-        orthophoto = gdal.Open(f"data/orthophotos/{site.orthophoto_name}.ecw")
-        source_info = gdal.Info(orthophoto, format="json")
-        resolution = source_info["geoTransform"][1]
-        left_offset = int(
-            (site.site_x - source_info["geoTransform"][0] - (clip_width / 2)) / resolution
+    # Only crop sites whose coordinates, orthophoto or output have changed since the last run
+    manifest = Manifest("crop_orthophotos")
+    _, suffix, _ = OUTPUT_FORMATS[output_format]
+    site_inputs = {
+        site.site: (
+            {
+                "site_x": site.site_x,
+                "site_y": site.site_y,
+                "orthophoto_name": site.orthophoto_name,
+                "output_format": output_format,
+            },
+            [f"data/orthophotos/{site.orthophoto_name}.ecw"],
         )
-        top_offset = int(
-            (source_info["geoTransform"][3] - site.site_y - (clip_width / 2)) / resolution
+        for site in site_metadata.itertuples()
+    }
+    changed_sites = site_metadata[
+        [not manifest.is_current(site, *site_inputs[site]) for site in site_metadata.site]
+    ]
+    print(f"Skipping {len(site_metadata) - len(changed_sites)} sites which are up to date")
+    profiler.count("crop_orthophotos.sites_skipped", len(site_metadata) - len(changed_sites))
+
+    # Many sites share an orthophoto, so crop them together to decode each ECW once. Orthophotos
+    # are cropped in parallel, unless workers=1
+    site_groups = [sites for _, sites in changed_sites.groupby("orthophoto_name", sort=False)]
+    crop = functools.partial(crop_orthophoto, output_format=output_format)
+    if workers is None:
+        workers = min(len(site_groups), os.cpu_count() or 1)
+    with profiler.stage("crop_orthophotos.crop"):
+        if workers > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                group_results = list(executor.map(crop, site_groups))
+        else:
+            group_results = [crop(sites) for sites in site_groups]
+    profiler.count("crop_orthophotos.sites_cropped", len(changed_sites))
+
+    for row in [row for rows in group_results for row in rows]:
+        manifest.record(
+            row["site"],
+            *site_inputs[row["site"]],
+            outputs=[f"data/site_images/{row['site']}{suffix}"],
+            data=row,
         )
+    manifest.save()
+
+    # Save orthophoto metadata, in the same order as the sites
+    orthophoto_metadata = pd.DataFrame([manifest.get_data(site) for site in site_metadata.site])
+    orthophoto_metadata.to_csv("data/orthophoto_metadata.csv", index=False)
+
+    profiler.save("data/crop_orthophotos")
+    print("Done")
+
+
+def crop_orthophoto(sites, output_format="png"):
+    """Crop each site from a single orthophoto, returning the orthophoto metadata for each site."""
+    driver, suffix, creation_options = OUTPUT_FORMATS[output_format]
+    orthophoto_name = sites.orthophoto_name.iloc[0]
+    orthophoto_path = f"data/orthophotos/{orthophoto_name}.ecw"
+    orthophoto = gdal.Open(orthophoto_path)
+    geo_transform = orthophoto.GetGeoTransform()
+    resolution = geo_transform[1]
+    if resolution != -geo_transform[5]:
+        raise ValueError(
+            f"Orthophoto X resolution ({resolution}) does not match "
+            f"Y resolution ({geo_transform[5]})"
+        )
+
+    orthophoto_list = []
+    for _, site in sites.iterrows():
+        print(f"Cropping {site.site}")
+        left_offset = int((site.site_x - geo_transform[0] - (CLIP_WIDTH / 2)) / resolution)
+        top_offset = int((geo_transform[3] - site.site_y - (CLIP_WIDTH / 2)) / resolution)
         gdal.Translate(
-            f"data/site_images/{site.site}.png",
+            f"data/site_images/{site.site}{suffix}",
             orthophoto,
-            format="PNG",
+            format=driver,
+            creationOptions=creation_options,
             srcWin=[
                 left_offset,
                 top_offset,
-                int(clip_width / resolution),
-                int(clip_width / resolution),
+                int(CLIP_WIDTH / resolution),
+                int(CLIP_WIDTH / resolution),
             ],
         )
 
-        # Save orthophoto metadata
-        if resolution != -source_info["geoTransform"][5]:
-            raise ValueError(
-                f"Orthophoto X resolution ({resolution}) does not match "
-                f"Y resolution ({source_info['geoTransform'][5]})"
-            )
         orthophoto_list.append(
             {
                 "site": site.site,
@@ -53,10 +123,7 @@ def main():
                 "corner_y": site.site_y + 1000,
             }
         )
-    orthophoto_metadata = pd.DataFrame(orthophoto_list)
-    orthophoto_metadata.to_csv("data/orthophoto_metadata.csv", index=False)
-
-    print("Done")
+    return orthophoto_list
 
 
 if __name__ == "__main__":
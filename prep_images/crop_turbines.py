@@ -1,91 +1,251 @@
+import concurrent.futures
+import io
 import os
 from pathlib import Path
 
 import dotenv
+import numpy as np
 import pandas as pd
-from osgeo import gdal
+from osgeo import gdal, gdal_array
 
+from common.manifest import Manifest
+from common.profiling import profiler
 
-def main():
+
+def main(site_image_suffix=None, workers=None):
+    """Crop each labelled turbine from its site image.
+
+    By default the site images are the jpg files exported from Roboflow. Set
+    site_image_suffix to ".vrt" or ".tif" to read from the VRTs or COGs written by
+    crop_orthophotos, so that only the pixels of each turbine are decoded.
+    """
     dotenv.load_dotenv(".env")
     dotenv.load_dotenv(".env.secret")
     full_labels = os.getenv("full_site_labels")
     orthophotos = pd.read_csv("data/orthophoto_metadata.csv")
 
+    # Each site image is read once, and turbine images are encoded by a pool of threads. Sites
+    # are skipped if their labels, site image and turbine images have not changed
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    manifest = Manifest("crop_turbines")
+    turbine_metadata = load_turbine_labels(full_labels, orthophotos, site_image_suffix)
+    for (dataset, image_path), turbine_labels in turbine_metadata.groupby(
+        ["dataset", "image_path"], sort=False
+    ):
+        site = turbine_labels.site.iloc[0]
+        site_inputs = turbine_labels[
+            ["turbine_num", "resolution", "left_offset", "top_offset", "max_size"]
+        ].to_dict("list")
+        output_paths = [
+            f"data/turbine_images/{dataset}/{site}_{turbine_num}.png"
+            for turbine_num in turbine_labels.turbine_num
+        ]
+        if manifest.is_current(f"{dataset}/{site}", site_inputs, [image_path]):
+            print(f"{site}: {len(turbine_labels)} images are up to date")
+            profiler.count("crop_turbines.sites_skipped")
+            continue
+        os.makedirs(f"data/turbine_images/{dataset}", exist_ok=True)
+
+        # Read the pixels covering every turbine in the site once. GDAL samples the nearest
+        # pixel for fractional srcWin offsets, which is the same as rounding half up
+        image = gdal.Open(str(image_path))
+        windows = turbine_labels.assign(
+            window_left=lambda x: np.floor(x.left_offset + 0.5).astype(int),
+            window_top=lambda x: np.floor(x.top_offset + 0.5).astype(int),
+            window_size=lambda x: x.max_size.astype(int),
+            window_right=lambda x: x.window_left + x.window_size,
+            window_bottom=lambda x: x.window_top + x.window_size,
+        )
+        read_left = min(max(windows.window_left.min(), 0), image.RasterXSize)
+        read_top = min(max(windows.window_top.min(), 0), image.RasterYSize)
+        read_right = max(min(windows.window_right.max(), image.RasterXSize), read_left)
+        read_bottom = max(min(windows.window_bottom.max(), image.RasterYSize), read_top)
+        with profiler.stage("crop_turbines.read_site"):
+            image_data = image.ReadAsArray(
+                int(read_left),
+                int(read_top),
+                int(read_right - read_left),
+                int(read_bottom - read_top),
+            )
+        geo_transform = image.GetGeoTransform(can_return_null=True)
+        with profiler.stage("crop_turbines.write_turbines"):
+            for future in [
+                executor.submit(
+                    write_turbine_image,
+                    output_path,
+                    image_data,
+                    window.window_left - read_left,
+                    window.window_top - read_top,
+                    window.window_size,
+                    window_geo_transform(geo_transform, window.window_left, window.window_top),
+                    image.GetProjection(),
+                )
+                for window, output_path in zip(windows.itertuples(), output_paths)
+            ]:
+                future.result()
+        profiler.count("crop_turbines.images_written", len(output_paths))
+        manifest.record(f"{dataset}/{site}", site_inputs, [image_path], outputs=output_paths)
+        print(f"{site}: {len(turbine_labels)} images created")
+    executor.shutdown()
+    manifest.save()
+
+    turbine_metadata.drop(columns=["dataset", "image_path"]).to_csv(
+        "data/turbine_image_metadata.csv", index=False
+    )
+    profiler.save("data/crop_turbines")
+    print("Done")
+
+
+def load_turbine_labels(full_labels, orthophotos, site_image_suffix=None):
+    """Load every YOLO label file for train, valid and test into a single table.
+
+    The files are parsed together in one pass, and orthophoto metadata is joined on the site.
+    Only turbine labels (class 0) are kept. Pixel positions and crop windows are calculated for
+    all turbines at once.
+    """
     # We will output square images at their natural resolution. They will be at
     # least 640 wide and include 10px of padding. We will use roboflow to resize
     # them to 640px (or smaller)
     output_size = 640
 
-    turbine_list = []
+    label_lines = []
+    label_files = []
     for dataset in ["train", "valid", "test"]:
-        label_paths = Path(f"data/turbine_shadow_data/{full_labels}/{dataset}/labels").glob("*")
-        os.makedirs(f"data/turbine_images/{dataset}", exist_ok=True)
-        for label_path in label_paths:
+        labels_path = Path(f"data/turbine_shadow_data/{full_labels}/{dataset}/labels")
+        for label_path in labels_path.glob("*"):
             site = label_path.name.split("_png")[0]
-            image_path = (
-                Path(f"data/turbine_shadow_data/{full_labels}/{dataset}/labels") / label_path.name
-            ).with_suffix(".jpg")
-            orthophoto = orthophotos[orthophotos.site.eq(site)].iloc[0]
-            turbine_labels = (
-                pd.concat(
-                    [
-                        pd.DataFrame(
-                            {
-                                "site": site,
-                                "src_width": int(2000 / orthophoto.resolution),
-                                "src_height": int(2000 / orthophoto.resolution),
-                                "resolution": orthophoto.resolution,
-                                "site_corner_x": orthophoto.corner_x,
-                                "site_corner_y": orthophoto.corner_y,
-                                "image_file": image_path.name,
-                                "zone": orthophoto.zone
-                            },
-                            index=[0],
-                        ),
-                        pd.read_csv(
-                            label_path,
-                            sep=" ",
-                            names=["center_x", "center_y", "width", "height"],
-                        ),
-                    ],
-                    axis=1,
-                )
-                .dropna()
-                .assign(
-                    turbine_num=lambda x: range(len(x)),
-                    center_x_px=lambda x: (x.center_x * x.src_width).astype(int),
-                    center_y_px=lambda x: (x.center_y * x.src_height).astype(int),
-                    width_px=lambda x: (x.width * x.src_width).astype(int),
-                    height_px=lambda x: (x.height * x.src_height).astype(int),
-                    # TODO: Handle overlaps for multiple turbines in a cropped image
-                    max_size=lambda x: (
-                        (x[["width_px", "height_px"]] + 20).assign(size=output_size).max(axis=1)
-                    ),
-                    left_offset=lambda x: x.center_x_px - x.max_size.divide(2),
-                    top_offset=lambda x: x.center_y_px - x.max_size.divide(2),
-                    turbine_corner_x=lambda x: x.site_corner_x + (x.left_offset * x.resolution),
-                    turbine_corner_y=lambda x: x.site_corner_y - (x.top_offset * x.resolution),
-                )
+            if site_image_suffix is None:
+                image_path = (labels_path / label_path.name).with_suffix(".jpg")
+            else:
+                image_path = Path("data/site_images") / f"{site}{site_image_suffix}"
+            lines = [line for line in label_path.read_text().splitlines() if line.strip()]
+            label_lines.extend(lines)
+            label_files.append(
+                {
+                    "dataset": dataset,
+                    "image_path": str(image_path),
+                    "site": site,
+                    "image_file": image_path.name,
+                    "num_labels": len(lines),
+                }
             )
-            turbine_list.append(turbine_labels)
-            image = gdal.Open(str(image_path))
-            for _, label in turbine_labels.iterrows():
-                gdal.Translate(
-                    f"data/turbine_images/{dataset}/{label.site}_{label.turbine_num}.png",
-                    image,
-                    format="PNG",
-                    srcWin=[
-                        label.left_offset,
-                        label.top_offset,
-                        label.max_size,
-                        label.max_size,
-                    ],
-                )
-            print(f"{label.site}: {len(turbine_labels)} images created")
-    turbine_metadata = pd.concat(turbine_list)
-    turbine_metadata.to_csv("data/turbine_image_metadata.csv", index=False)
-    print("Done")
+
+    label_files = pd.DataFrame(
+        label_files, columns=["dataset", "image_path", "site", "image_file", "num_labels"]
+    )
+    labels = pd.read_csv(
+        io.StringIO("\n".join(label_lines)),
+        sep=" ",
+        header=None,
+        names=["label", "center_x", "center_y", "width", "height"],
+        usecols=range(5),
+    ).assign(file_num=np.repeat(np.arange(len(label_files)), label_files.num_labels))
+
+    orthophotos = orthophotos.set_index("site")
+    turbine_labels = (
+        labels[labels.label.eq(0)]
+        .join(label_files.drop(columns="num_labels"), on="file_num")
+        .join(orthophotos[["resolution", "corner_x", "corner_y", "zone"]], on="site")
+        .assign(
+            src_width=lambda x: (2000 / x.resolution).astype(int),
+            src_height=lambda x: (2000 / x.resolution).astype(int),
+            site_corner_x=lambda x: x.corner_x,
+            site_corner_y=lambda x: x.corner_y,
+            turbine_num=lambda x: x.groupby("file_num").cumcount(),
+            center_x_px=lambda x: (x.center_x * x.src_width).astype(int),
+            center_y_px=lambda x: (x.center_y * x.src_height).astype(int),
+            width_px=lambda x: (x.width * x.src_width).astype(int),
+            height_px=lambda x: (x.height * x.src_height).astype(int),
+            # TODO: Handle overlaps for multiple turbines in a cropped image
+            max_size=lambda x: np.maximum(
+                np.maximum(x.width_px, x.height_px) + 20, output_size
+            ),
+            left_offset=lambda x: x.center_x_px - x.max_size.divide(2),
+            top_offset=lambda x: x.center_y_px - x.max_size.divide(2),
+            turbine_corner_x=lambda x: x.site_corner_x + (x.left_offset * x.resolution),
+            turbine_corner_y=lambda x: x.site_corner_y - (x.top_offset * x.resolution),
+        )
+        .reset_index(drop=True)
+    )
+    return turbine_labels[
+        [
+            "dataset",
+            "image_path",
+            "site",
+            "src_width",
+            "src_height",
+            "resolution",
+            "site_corner_x",
+            "site_corner_y",
+            "image_file",
+            "zone",
+            "center_x",
+            "center_y",
+            "width",
+            "height",
+            "turbine_num",
+            "center_x_px",
+            "center_y_px",
+            "width_px",
+            "height_px",
+            "max_size",
+            "left_offset",
+            "top_offset",
+            "turbine_corner_x",
+            "turbine_corner_y",
+        ]
+    ]
+
+
+def write_turbine_image(
+    path, image_data, left_offset, top_offset, size, geo_transform=None, projection=""
+):
+    """Write a square window of an image array to png, padding with zeros beyond its edges.
+
+    Windows inside the array are written from a view of image_data without copying it.
+    """
+    if image_data.ndim == 2:
+        image_data = image_data[np.newaxis]
+    _, height, width = image_data.shape
+
+    if (
+        left_offset >= 0
+        and top_offset >= 0
+        and left_offset + size <= width
+        and top_offset + size <= height
+    ):
+        window = image_data[:, top_offset : top_offset + size, left_offset : left_offset + size]
+    else:
+        window = np.zeros((image_data.shape[0], size, size), dtype=image_data.dtype)
+        source_left, source_top = max(left_offset, 0), max(top_offset, 0)
+        source_right = min(left_offset + size, width)
+        source_bottom = min(top_offset + size, height)
+        if source_right > source_left and source_bottom > source_top:
+            window[
+                :,
+                source_top - top_offset : source_bottom - top_offset,
+                source_left - left_offset : source_right - left_offset,
+            ] = image_data[:, source_top:source_bottom, source_left:source_right]
+
+    window_dataset = gdal_array.OpenArray(window if window.shape[0] > 1 else window[0])
+    if geo_transform is not None:
+        window_dataset.SetGeoTransform(geo_transform)
+        window_dataset.SetProjection(projection)
+    gdal.GetDriverByName("PNG").CreateCopy(path, window_dataset)
+
+
+def window_geo_transform(geo_transform, left_offset, top_offset):
+    """Geotransform of a window of an image, or None if the image is not georeferenced."""
+    if geo_transform is None:
+        return None
+    return (
+        geo_transform[0] + left_offset * geo_transform[1] + top_offset * geo_transform[2],
+        geo_transform[1],
+        geo_transform[2],
+        geo_transform[3] + left_offset * geo_transform[4] + top_offset * geo_transform[5],
+        geo_transform[4],
+        geo_transform[5],
+    )
 
 
 if __name__ == "__main__":
@@ -1,13 +1,35 @@
+import concurrent.futures
+import hashlib
+import json
 import os
 import pathlib
 import re
-import shutil
 import zipfile
 
 import dotenv
 import geopandas as gpd
+import numpy as np
 import pandas as pd
-import pyodbc
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from common.files import file_signature
+from common.profiling import profiler
+from prep_images import tile_catalog
+from prep_images.photo_table import PhotoTable
+
+# The combined photo table in data/photo_metadata/cache
+PHOTO_TABLE_FILE = "photo_table.parquet"
+
+# Columns of the table written for each database, as returned by parse_photo_rows
+PHOTO_SCHEMA = pa.schema(
+    [
+        ("photo_file", pa.string()),
+        ("photo_latitude", pa.float64()),
+        ("photo_longitude", pa.float64()),
+        ("photo_timestamp", pa.timestamp("ns", tz="UTC")),
+    ]
+)
 
 
 def main():
@@ -55,32 +77,17 @@ def main():
         )
     )
 
-    # Load shape files giving the location of each orthophoto tile
-    shutil.unpack_archive(
-        "data/photo_metadata/fechas_ortofotos_PNOA_MA.zip",
-        "data/photo_metadata/orthophoto_tiles",
-    )
-    orthophoto_tiles = gpd.read_file(
-        "data/photo_metadata/orthophoto_tiles/20220923_Estado_Mosaicos_109_MA"  # noqa
-        "/20220923_Estado_Mosaicos_MA_MR.shp"  # noqa
-    ).assign(tile_centroid=lambda x: x.geometry.centroid)
-
-    # Join orthophoto tiles to sites. If there are duplicates keep the one where
-    # the site is closest to the centroid of the tile
-    site_tiles = (
-        gpd.sjoin(sites, orthophoto_tiles, how="left", predicate="within")
-        .assign(
-            distance_to_centroid=lambda x: x.distance(x.tile_centroid),
-            orthophoto_name=lambda x: (
-                "PNOA_MA_OF_ETRS89_HU"
-                + x.HUSO.astype(str)
-                + "_H50_"
-                + x.HMTN50.astype(str)
-            ),
-        )
-        .sort_values(["site", "distance_to_centroid"])
-        .drop_duplicates("site")
-        .drop(columns="index_right")
+    # Find the orthophoto tile containing each site from the tile catalog. If tiles overlap,
+    # the catalog chooses the tile whose centroid is closest to the site
+    orthophoto_catalog = tile_catalog.load_catalog("orthophoto")
+    tile_positions = orthophoto_catalog.lookup(sites.geometry.x, sites.geometry.y)
+    orthophoto_tiles = orthophoto_catalog.metadata.reindex(tile_positions)
+    site_tiles = sites.assign(
+        HUSO=orthophoto_tiles.HUSO.to_numpy(),
+        HMTN50=orthophoto_tiles.HMTN50.to_numpy(),
+        orthophoto_name=lambda x: (
+            "PNOA_MA_OF_ETRS89_HU" + x.HUSO.astype(str) + "_H50_" + x.HMTN50.astype(str)
+        ),
     )
 
     # The orthophotos actually use three different projections for UTM zones 29, 30 and 31
@@ -100,7 +107,7 @@ def main():
         ]
 
     # Join with photo metadata to find timestamp of the nearest photo
-    photo_metadata = load_photo_metadata()
+    photo_metadata = load_photo_metadata().to_geodataframe()
     site_photos = (
         gpd.sjoin_nearest(
             site_tiles, photo_metadata, how="left", distance_col="photo_distance"
@@ -133,96 +140,264 @@ def main():
     print("Done")
 
 
-def load_photo_metadata():
-    """Load aerial photo metadata from zipped access database files"""
+def load_photo_metadata(use_cache=True, workers=None, read_only=False):
+    """Load aerial photo metadata from zipped access database files, as a PhotoTable
+
+    The combined table is cached in data/photo_metadata/cache, keyed on the size and
+    modification time of each zip and database file. Only databases which have changed are
+    queried again, in a pool of worker processes. Set workers=1 to query them serially. If
+    read_only is set, the cached table is read without checking or rebuilding it.
+    """
     metadata_path = pathlib.Path("data/photo_metadata")
+    cache_path = metadata_path / "cache"
+    if read_only:
+        return PhotoTable.read_parquet(cache_path / PHOTO_TABLE_FILE)
+    manifest = read_cache_manifest(cache_path) if use_cache else {}
+
+    zip_signatures = {
+        zip_path.name: file_signature(zip_path) for zip_path in metadata_path.glob("**/*.zip")
+    }
+    changed_zips = [
+        zip_path
+        for zip_path in metadata_path.glob("**/*.zip")
+        if manifest.get("zip_files", {}).get(zip_path.name) != zip_signatures[zip_path.name]
+    ]
+    database_files = unzip_database_files(metadata_path, changed_zips if manifest else None)
+    database_signatures = {
+        database_file.name: file_signature(database_file) for database_file in database_files
+    }
+
+    # If nothing has changed, the combined table can be loaded directly
+    cache_key = photo_cache_key(zip_signatures, database_signatures)
+    photos_path = cache_path / PHOTO_TABLE_FILE
+    if use_cache and manifest.get("key") == cache_key and photos_path.exists():
+        photos = PhotoTable.read_parquet(photos_path)
+        profiler.count("photo_metadata.cache_hits")
+        print(f"Loaded {len(photos)} photos from cache.")
+        return photos
+
+    # Load all photo timestamps into a single dataframe, reusing unchanged databases
+    photo_list = []
+    failed_files = []
+    changed_files = []
+    for database_file in database_files:
+        table_path = cache_path / "databases" / f"{database_file.stem}.parquet"
+        cached_signature = manifest.get("databases", {}).get(database_file.name)
+        if use_cache and cached_signature == database_signatures[database_file.name]:
+            if database_file.name in manifest.get("failed_files", []):
+                print(f"Skipping {database_file} because the query failed.")
+                failed_files.append(database_file.name)
+                continue
+            if table_path.exists():
+                photo_list.append(pd.read_parquet(table_path))
+                profiler.count("photo_metadata.databases_cached")
+                continue
+        changed_files.append(database_file)
+
+    # Query changed databases in parallel, with one worker process per database. Each worker
+    # writes its table to parquet, so only the table path is returned
+    table_paths = [
+        cache_path / "databases" / f"{database_file.stem}.parquet"
+        for database_file in changed_files
+    ]
+    if workers is None:
+        workers = min(len(changed_files), os.cpu_count() or 1)
+    with profiler.stage("photo_metadata.query_databases"):
+        if workers > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                database_results = list(executor.map(read_database, changed_files, table_paths))
+        else:
+            database_results = [
+                read_database(database_file, table_path)
+                for database_file, table_path in zip(changed_files, table_paths)
+            ]
+    profiler.count("photo_metadata.databases_queried", len(changed_files))
+
+    for database_file, table_path in zip(changed_files, database_results):
+        if table_path is None:
+            failed_files.append(database_file.name)
+            profiler.count("photo_metadata.databases_failed")
+            continue
+        photo_list.append(pd.read_parquet(table_path))
+    if len(failed_files) > 0:
+        print(f"Skipped {len(failed_files)} database files: {', '.join(sorted(failed_files))}")
+
+    photos = build_photo_table(photo_list)
+
+    if use_cache:
+        photos.to_parquet(photos_path)
+        write_cache_manifest(
+            cache_path,
+            {
+                "key": cache_key,
+                "zip_files": zip_signatures,
+                "databases": database_signatures,
+                "failed_files": failed_files,
+            },
+        )
+        print(f"Saved {len(photos)} photos to cache.")
+
+    return photos
+
+
+def build_photo_table(photo_list):
+    """Combine tables of photo timestamps into a PhotoTable of photo centroids in EPSG:25830"""
+    if len(photo_list) == 0:
+        return PhotoTable.empty()
+    return PhotoTable.from_photos(pd.concat(photo_list, ignore_index=True))
+
+
+def unzip_database_files(metadata_path, zip_files=None):
+    """Unzip PNOA access databases. If zip_files is None, only unzip if none are present."""
     database_files = list(metadata_path.glob("**/PNOA*.mdb"))
-    if len(database_files) > 0:
-        # TODO: Implement logging
-        print("Database files are already unzipped.")
-    else:
+    if zip_files is None:
+        if len(database_files) > 0:
+            # TODO: Implement logging
+            print("Database files are already unzipped.")
+            return database_files
         zip_files = list(metadata_path.glob("**/*.zip"))
         if len(zip_files) == 0:
             print("Please copy zip files to data/photo_metadata.")
-        else:
-            # Abbreviation PNOA: Plan Nacional de Ortofotografía Aérea  # noqa
-            pnoa_regex = re.compile(".*/PNOA_.*mdb")
-            for zip_path in zip_files:
-                with zipfile.ZipFile(zip_path, "r") as zp:
-                    zipped_files = zipfile.ZipFile.infolist(zp)
-                    for zipped_file in zipped_files:
-                        if pnoa_regex.match(zipped_file.filename):
-                            with open(
-                                metadata_path / zipped_file.filename.split("/")[-1],
-                                "wb",
-                            ) as f:
-                                f.write(zp.read(zipped_file.filename))
-        database_files = list(metadata_path.glob("**/PNOA*.mdb"))
-        print(f"Unzipped {len(database_files)} database files.")
-
-    # Load all photo timestamps into a single dataframe
-    photo_list = []
-    for database_file in database_files:
-        connection_string = (
-            r"DRIVER={Microsoft Access Driver (*.mdb, *.accdb)};"
-            rf"DBQ={str(database_file.resolve())};"
-        )
-        try:
-            with pyodbc.connect(connection_string) as connection:
-                cursor = connection.cursor()
-                results = pd.DataFrame.from_records(
-                    cursor.execute(
-                        "SELECT FOTOGRAMA_TIFF, FECHA, HORA, LAT_ETRS89, LONG_ETRS89 "  # noqa
-                        "FROM VueloEjecutado"  # noqa
-                    ).fetchall(),
-                    columns=[
-                        "photo_file",
-                        "date",
-                        "time",
-                        "photo_latitude",
-                        "photo_longitude",
-                    ],
+            return database_files
+    elif len(zip_files) == 0:
+        return database_files
+
+    # Abbreviation PNOA: Plan Nacional de Ortofotografía Aérea  # noqa
+    pnoa_regex = re.compile(".*/PNOA_.*mdb")
+    for zip_path in zip_files:
+        with zipfile.ZipFile(zip_path, "r") as zp:
+            zipped_files = zipfile.ZipFile.infolist(zp)
+            for zipped_file in zipped_files:
+                if pnoa_regex.match(zipped_file.filename):
+                    with open(
+                        metadata_path / zipped_file.filename.split("/")[-1],
+                        "wb",
+                    ) as f:
+                        f.write(zp.read(zipped_file.filename))
+    database_files = list(metadata_path.glob("**/PNOA*.mdb"))
+    print(f"Unzipped {len(database_files)} database files.")
+    return database_files
+
+
+def read_database(database_file, table_path, chunk_size=50000):
+    """Write photo timestamps and locations from a PNOA access database to a parquet table
+
+    Rows are streamed in chunks of chunk_size and each chunk is appended to the table once it
+    is parsed, so that peak memory does not depend on the size of the flight. Returns the table
+    path, or None if the query fails.
+    """
+    table_path = pathlib.Path(table_path)
+    table_path.parent.mkdir(parents=True, exist_ok=True)
+    temporary_path = table_path.with_name(f"{table_path.name}.{os.getpid()}.tmp")
+    try:
+        with pq.ParquetWriter(temporary_path, PHOTO_SCHEMA) as writer:
+            for photos in read_database_chunks(database_file, chunk_size):
+                writer.write_table(
+                    pa.Table.from_pandas(photos, schema=PHOTO_SCHEMA, preserve_index=False)
                 )
+        os.replace(temporary_path, table_path)
 
-                # There is a mixture of datetime objects and strings. Format them all as strings
-                # Then combine
-                if pd.api.types.infer_dtype(results.date) == "string":
-                    results.date = results.date.str.slice(0, 11)
-                else:
-                    results.date = results.date.dt.strftime(date_format="%d/%m/%Y")
-                if pd.api.types.infer_dtype(results.time) == "string":
-                    results.time = (
-                        results.time.str.strip()
-                        .str.replace("60", "00")
-                        .str.replace("1899-12-39 ", "")
-                    )
-                else:
-                    results.time = results.time.dt.strftime(date_format="%X")
-                results = results.assign(
-                    photo_timestamp=lambda x: pd.to_datetime(
-                        x.date + " " + x.time, dayfirst=True, utc=True
-                    )
-                ).drop(columns=["date", "time"])
-                photo_list.append(results)
-
-        # TODO: Can we fix these errors. 16/91 labels are being dropped
-        except (pyodbc.ProgrammingError, pyodbc.Error):
-            print(f"Skipping {database_file} because the query failed.")
-    photos = (
-        pd.concat(photo_list)
-        .sort_values("photo_file")
-        .assign(
-            geometry=lambda x: gpd.points_from_xy(
-                x.photo_longitude, x.photo_latitude, crs="ETRS89"
+    # TODO: Can we fix these errors. 16/91 labels are being dropped
+    except database_errors():
+        print(f"Skipping {database_file} because the query failed.")
+        return None
+
+    finally:
+        # Remove the partial table if the query failed
+        temporary_path.unlink(missing_ok=True)
+    return table_path
+
+
+def read_database_chunks(database_file, chunk_size=50000):
+    """Generate chunks of typed photo rows from a PNOA access database, through pyodbc"""
+    # pyodbc needs unixODBC on Linux, so it is only imported when a database is read
+    import pyodbc
+
+    connection_string = (
+        r"DRIVER={Microsoft Access Driver (*.mdb, *.accdb)};"
+        rf"DBQ={str(database_file.resolve())};"
+    )
+    with pyodbc.connect(connection_string) as connection:
+        cursor = connection.cursor()
+        cursor.execute(
+            "SELECT FOTOGRAMA_TIFF, FECHA, HORA, LAT_ETRS89, LONG_ETRS89 "  # noqa
+            "FROM VueloEjecutado"  # noqa
+        )
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if len(rows) == 0:
+                break
+            yield parse_photo_rows(rows)
+
+
+def database_errors():
+    """Exceptions raised by failed pyodbc queries, which are empty if pyodbc is not installed"""
+    try:
+        import pyodbc
+    except ImportError:
+        return ()
+    return (pyodbc.Error,)
+
+
+def parse_photo_rows(rows):
+    """Convert a chunk of VueloEjecutado rows into typed columns"""
+    photo_file, raw_date, raw_time, latitude, longitude = (
+        pd.Series(column) for column in zip(*rows)
+    )
+
+    # There is a mixture of datetime objects and strings. Parse dates as dd/mm/yyyy and times
+    # as hh:mm:ss, then combine
+    try:
+        if pd.api.types.infer_dtype(raw_date) == "string":
+            date = pd.to_datetime(raw_date.str.slice(0, 10), format="%d/%m/%Y")
+        else:
+            date = pd.to_datetime(raw_date).dt.normalize()
+        if pd.api.types.infer_dtype(raw_time) == "string":
+            time = pd.to_timedelta(
+                raw_time.str.strip().str.replace("60", "00").str.replace("1899-12-39 ", "")
             )
+        else:
+            time = pd.to_datetime(raw_time)
+            time = time - time.dt.normalize()
+        photo_timestamp = (date + time).dt.tz_localize("UTC")
+    except ValueError:
+        # Fall back to format inference from the raw values if a database uses an unexpected
+        # layout
+        photo_timestamp = pd.to_datetime(
+            raw_date.astype(str).str.slice(0, 11) + " " + raw_time.astype(str).str.strip(),
+            dayfirst=True,
+            utc=True,
         )
-        .set_geometry("geometry")
-        .to_crs("EPSG:25830")
-        .assign(photo_centroid=lambda x: x.geometry)
-        .reset_index(drop=True)
+
+    return pd.DataFrame(
+        {
+            "photo_file": photo_file.to_numpy(dtype=object),
+            "photo_latitude": latitude.to_numpy(dtype=np.float64),
+            "photo_longitude": longitude.to_numpy(dtype=np.float64),
+            "photo_timestamp": photo_timestamp,
+        }
     )
 
-    return photos
+
+def photo_cache_key(zip_signatures, database_signatures):
+    """Key for the combined photo table, which changes if any source file changes"""
+    return hashlib.sha1(
+        json.dumps([zip_signatures, database_signatures], sort_keys=True).encode()
+    ).hexdigest()
+
+
+def read_cache_manifest(cache_path):
+    try:
+        with open(cache_path / "manifest.json") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def write_cache_manifest(cache_path, manifest):
+    cache_path.mkdir(parents=True, exist_ok=True)
+    with open(cache_path / "manifest.json", "w") as f:
+        json.dump(manifest, f, indent=2)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,290 @@
+import pathlib
+import shutil
+import sqlite3
+import subprocess
+
+import numpy as np
+import pandas as pd
+
+from common.files import file_signature
+from evaluate import transforms
+from prep_images.load_photo_metadata import (
+    database_errors,
+    parse_photo_rows,
+    read_database_chunks,
+    unzip_database_files,
+)
+from prep_images.photo_table import PhotoTable
+
+PHOTO_STORE_PATH = pathlib.Path("data/photo_metadata/photo_store.sqlite")
+
+# Photo centroids are indexed in EPSG:25830, as in load_photo_metadata. Each point is stored as
+# a zero sized box in the R-tree
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS photos (
+    id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL,
+    photo_file TEXT NOT NULL,
+    photo_timestamp INTEGER NOT NULL,
+    photo_latitude REAL NOT NULL,
+    photo_longitude REAL NOT NULL,
+    x REAL NOT NULL,
+    y REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS photos_source ON photos (source);
+CREATE VIRTUAL TABLE IF NOT EXISTS photos_rtree USING rtree(id, min_x, max_x, min_y, max_y);
+CREATE TABLE IF NOT EXISTS sources (
+    source TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    num_photos INTEGER
+);
+"""
+
+
+def main():
+    convert_databases()
+
+
+class PhotoStore:
+    """Photo timestamps in a SQLite database, with an R-tree index on the photo centroids.
+
+    Queries return only the photos in a bounding box or within a radius of a set of points, as
+    a PhotoTable like load_photo_metadata. The database is a single portable file,
+    so it can be built once on Windows and copied to workers without the Access driver.
+    """
+
+    def __init__(self, path=PHOTO_STORE_PATH):
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def sources(self):
+        """Size and modification time of each imported source file"""
+        return {
+            source: {"size": size, "mtime_ns": mtime_ns}
+            for source, size, mtime_ns in self.connection.execute(
+                "SELECT source, size, mtime_ns FROM sources"
+            )
+        }
+
+    def remove_source(self, source):
+        """Delete the photos from a source, such as a database which has been removed."""
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM photos_rtree WHERE id IN (SELECT id FROM photos WHERE source = ?)",
+                (source,),
+            )
+            self.connection.execute("DELETE FROM photos WHERE source = ?", (source,))
+            self.connection.execute("DELETE FROM sources WHERE source = ?", (source,))
+
+    def import_photos(self, source, photo_chunks, signature=None):
+        """Replace the photos from a source, returning the number of photos imported.
+
+        photo_chunks is a DataFrame, or an iterable of DataFrames, with the columns returned by
+        parse_photo_rows. Each source is imported in one transaction, so a failed import leaves
+        the previous photos in place.
+        """
+        if isinstance(photo_chunks, pd.DataFrame):
+            photo_chunks = [photo_chunks]
+        signature = signature or {"size": None, "mtime_ns": None}
+        num_photos = 0
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM photos_rtree WHERE id IN (SELECT id FROM photos WHERE source = ?)",
+                (source,),
+            )
+            self.connection.execute("DELETE FROM photos WHERE source = ?", (source,))
+            (next_id,) = self.connection.execute(
+                "SELECT COALESCE(MAX(id), 0) + 1 FROM photos"
+            ).fetchone()
+            for photos in photo_chunks:
+                # Photos without a file name cannot be matched to an image
+                photos = photos.dropna(subset=["photo_file"])
+                ids = np.arange(next_id, next_id + len(photos))
+                next_id += len(photos)
+                x, y = transforms.get_transformer("ETRS89", "EPSG:25830").transform(
+                    photos.photo_latitude.to_numpy(), photos.photo_longitude.to_numpy()
+                )
+                timestamps = (
+                    pd.DatetimeIndex(photos.photo_timestamp)
+                    .tz_convert("UTC")
+                    .to_numpy(dtype="datetime64[ns]")
+                    .astype(np.int64)
+                )
+                self.connection.executemany(
+                    "INSERT INTO photos VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    zip(
+                        ids.tolist(),
+                        [source] * len(photos),
+                        photos.photo_file.astype(str).tolist(),
+                        timestamps.tolist(),
+                        photos.photo_latitude.tolist(),
+                        photos.photo_longitude.tolist(),
+                        x.tolist(),
+                        y.tolist(),
+                    ),
+                )
+                self.connection.executemany(
+                    "INSERT INTO photos_rtree VALUES (?, ?, ?, ?, ?)",
+                    zip(ids.tolist(), x.tolist(), x.tolist(), y.tolist(), y.tolist()),
+                )
+                num_photos += len(photos)
+            self.connection.execute(
+                "INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)",
+                (source, signature["size"], signature["mtime_ns"], num_photos),
+            )
+        return num_photos
+
+    def query_bbox(self, min_x, min_y, max_x, max_y):
+        """Photos with a centroid inside an EPSG:25830 bounding box"""
+        return self.read_photos(
+            "SELECT p.* FROM photos_rtree r JOIN photos p ON p.id = r.id "
+            "WHERE r.max_x >= ? AND r.min_x <= ? AND r.max_y >= ? AND r.min_y <= ?",
+            (min_x, max_x, min_y, max_y),
+        )
+
+    def query_radius(self, x_coordinates, y_coordinates, radius=3100):
+        """Photos with a centroid within radius of any of a set of EPSG:25830 points
+
+        The points are loaded into a temporary table, so that every point is matched against
+        the R-tree in a single query.
+        """
+        points = zip(
+            np.atleast_1d(np.asarray(x_coordinates, dtype=float)).tolist(),
+            np.atleast_1d(np.asarray(y_coordinates, dtype=float)).tolist(),
+        )
+        with self.connection:
+            self.connection.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS query_points (x REAL, y REAL)"
+            )
+            self.connection.execute("DELETE FROM query_points")
+            self.connection.executemany("INSERT INTO query_points VALUES (?, ?)", points)
+        return self.read_photos(
+            "SELECT DISTINCT p.* FROM query_points q "
+            "JOIN photos_rtree r ON r.min_x <= q.x + :radius AND r.max_x >= q.x - :radius "
+            "AND r.min_y <= q.y + :radius AND r.max_y >= q.y - :radius "
+            "JOIN photos p ON p.id = r.id "
+            "WHERE (p.x - q.x) * (p.x - q.x) + (p.y - q.y) * (p.y - q.y) <= :radius * :radius",
+            {"radius": float(radius)},
+        )
+
+    def read_photos(self, query, parameters):
+        photos = pd.read_sql_query(query, self.connection, params=parameters).sort_values(
+            ["photo_file", "id"]
+        )
+        file_codes, file_names = pd.factorize(photos.photo_file.to_numpy(dtype=object), sort=True)
+        return PhotoTable(
+            photos.x.to_numpy(),
+            photos.y.to_numpy(),
+            photos.photo_timestamp.to_numpy(dtype=np.int64),
+            file_codes,
+            file_names,
+        )
+
+
+def convert_databases(path=PHOTO_STORE_PATH, chunk_size=50000):
+    """Import every PNOA access database into the photo store, skipping unchanged files."""
+    metadata_path = pathlib.Path("data/photo_metadata")
+    store = PhotoStore(path)
+    sources = store.sources()
+    database_files = sorted(unzip_database_files(metadata_path))
+    for source in sorted(set(sources) - {database_file.name for database_file in database_files}):
+        store.remove_source(source)
+        print(f"Removed {source} because the database no longer exists")
+    failed_files = []
+    for database_file in database_files:
+        signature = file_signature(database_file)
+        if sources.get(database_file.name) == signature:
+            print(f"{database_file.name} is up to date")
+            continue
+        try:
+            num_photos = store.import_photos(
+                database_file.name, read_mdb_chunks(database_file, chunk_size), signature
+            )
+        except (*database_errors(), subprocess.CalledProcessError, ValueError):
+            print(f"Skipping {database_file} because the query failed.")
+            failed_files.append(database_file.name)
+            continue
+        print(f"Imported {num_photos} photos from {database_file.name}")
+    store.close()
+    if len(failed_files) > 0:
+        print(f"Skipped {len(failed_files)} database files: {', '.join(failed_files)}")
+    print("Done")
+
+
+def store_is_current(path=PHOTO_STORE_PATH):
+    """True if the photo store exists and holds the current version of every photo database.
+
+    If there are no databases, as on a worker with a copy of the store, the store is used as it
+    is. Otherwise a warning is printed if the store is out of date.
+    """
+    path = pathlib.Path(path)
+    if not path.exists():
+        return False
+    database_files = list(pathlib.Path("data/photo_metadata").glob("**/PNOA*.mdb"))
+    if len(database_files) == 0:
+        return True
+    database_signatures = {
+        database_file.name: file_signature(database_file) for database_file in database_files
+    }
+    store = PhotoStore(path)
+    sources = store.sources()
+    store.close()
+    if sources != database_signatures:
+        print(f"{path} is out of date, so the photo metadata cache is used instead.")
+        print("Run prep_images/photo_store.py to update it.")
+        return False
+    return True
+
+
+def read_mdb_chunks(database_file, chunk_size=50000):
+    """Read a PNOA access database with mdbtools if it is installed, otherwise with pyodbc.
+
+    The Microsoft Access driver is only available on Windows, while mdbtools is available
+    for Linux and macOS.
+    """
+    if shutil.which("mdb-export") is not None:
+        return export_database_chunks(database_file, chunk_size)
+    return read_database_chunks(database_file, chunk_size)
+
+
+def export_database_chunks(database_file, chunk_size=50000):
+    """Generate chunks of typed photo rows from mdb-export, without loading the whole table"""
+    process = subprocess.Popen(
+        [
+            "mdb-export",
+            "-D",
+            "%d/%m/%Y",
+            "-T",
+            "%d/%m/%Y %H:%M:%S",
+            str(database_file),
+            "VueloEjecutado",  # noqa
+        ],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    columns = ["FOTOGRAMA_TIFF", "FECHA", "HORA", "LAT_ETRS89", "LONG_ETRS89"]  # noqa
+    try:
+        for rows in pd.read_csv(
+            process.stdout,
+            usecols=columns,
+            dtype={"FOTOGRAMA_TIFF": str, "FECHA": str, "HORA": str},  # noqa
+            chunksize=chunk_size,
+        ):
+            # Times are exported with the 1899-12-30 date used by Access, so keep the time
+            rows = rows[columns].assign(HORA=lambda x: x.HORA.str.strip().str.slice(-8))
+            yield parse_photo_rows(rows.itertuples(index=False, name=None))
+    finally:
+        process.stdout.close()
+        return_code = process.wait()
+    if return_code != 0:
+        raise subprocess.CalledProcessError(return_code, process.args)
+
+
+if __name__ == "__main__":
+    main()
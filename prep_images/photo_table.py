@@ -0,0 +1,147 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from evaluate import transforms
+
+
+class PhotoTable:
+    """Aerial photo centroids, timestamps and file names, stored as arrays.
+
+    Centroids are float64 EPSG:25830 coordinates, timestamps are int64 nanoseconds since the
+    Unix epoch in UTC, and file names are dictionary encoded as int32 codes into a fixed width
+    bytes array of unique names. This takes 28 bytes per photo plus the length of each unique
+    name, rather than several hundred bytes for a GeoDataFrame with shapely points and Python
+    strings. Timestamps, file names and geometries are only created for the rows that are asked
+    for.
+    """
+
+    def __init__(self, x, y, timestamps, file_codes, file_names):
+        self.x = np.ascontiguousarray(x, dtype=np.float64)
+        self.y = np.ascontiguousarray(y, dtype=np.float64)
+        self.timestamps = np.ascontiguousarray(timestamps, dtype=np.int64)
+        self.file_codes = np.ascontiguousarray(file_codes, dtype=np.int32)
+        file_names = np.asarray(file_names)
+        if file_names.dtype.kind != "S":
+            file_names = np.char.encode(file_names.astype(str), "utf-8")
+        self.file_names = file_names
+
+    @classmethod
+    def from_photos(cls, photos):
+        """Build a table from photo_file, photo_timestamp, photo_latitude and photo_longitude.
+
+        Photos are sorted by file name, as in the photo metadata cache. Photos without a file
+        name are dropped, as they cannot be matched to an image.
+        """
+        photos = photos[photos.photo_file.notna()]
+        x, y = transforms.get_transformer("ETRS89", "EPSG:25830").transform(
+            photos.photo_latitude.to_numpy(dtype=np.float64),
+            photos.photo_longitude.to_numpy(dtype=np.float64),
+        )
+        timestamps = (
+            pd.DatetimeIndex(photos.photo_timestamp)
+            .tz_convert("UTC")
+            .to_numpy(dtype="datetime64[ns]")
+            .astype(np.int64)
+        )
+        file_codes, file_names = pd.factorize(photos.photo_file.to_numpy(dtype=object), sort=True)
+        order = np.argsort(file_codes, kind="stable")
+        return cls(x[order], y[order], timestamps[order], file_codes[order], file_names)
+
+    @classmethod
+    def empty(cls):
+        return cls([], [], [], [], [])
+
+    def __len__(self):
+        return len(self.x)
+
+    @property
+    def nbytes(self):
+        return (
+            self.x.nbytes
+            + self.y.nbytes
+            + self.timestamps.nbytes
+            + self.file_codes.nbytes
+            + self.file_names.nbytes
+        )
+
+    def take(self, positions):
+        """Return a table of the photos at the given row positions."""
+        return PhotoTable(
+            self.x[positions],
+            self.y[positions],
+            self.timestamps[positions],
+            self.file_codes[positions],
+            self.file_names,
+        )
+
+    def photo_file(self, positions=slice(None)):
+        return np.char.decode(self.file_names[self.file_codes[positions]], "utf-8")
+
+    def photo_timestamp(self, positions=slice(None)):
+        return pd.to_datetime(self.timestamps[positions], unit="ns", utc=True)
+
+    def geometry(self, positions=slice(None)):
+        return gpd.GeoSeries(
+            gpd.points_from_xy(self.x[positions], self.y[positions]), crs="EPSG:25830"
+        )
+
+    def to_geodataframe(self):
+        """GeoDataFrame in the layout of the original photo metadata, with shapely points."""
+        latitude, longitude = transforms.get_transformer("EPSG:25830", "ETRS89").transform(
+            self.x, self.y
+        )
+        geometry = gpd.points_from_xy(self.x, self.y, crs="EPSG:25830")
+        return gpd.GeoDataFrame(
+            {
+                "photo_file": self.photo_file(),
+                "photo_latitude": latitude,
+                "photo_longitude": longitude,
+                "photo_timestamp": self.photo_timestamp(),
+            },
+            geometry=geometry,
+        ).assign(photo_centroid=lambda x: x.geometry)
+
+    def to_parquet(self, path):
+        pd.DataFrame(
+            {
+                "photo_file": pd.Categorical.from_codes(
+                    self.file_codes, np.char.decode(self.file_names, "utf-8")
+                ),
+                "photo_timestamp": self.timestamps,
+                "x": self.x,
+                "y": self.y,
+            }
+        ).to_parquet(path, index=False)
+
+    @classmethod
+    def read_parquet(cls, path):
+        """Read a table written by to_parquet, without creating a Python string for each name."""
+        table = pq.read_table(path, read_dictionary=["photo_file"]).unify_dictionaries()
+        if table.num_rows == 0:
+            return cls.empty()
+        photo_file = table.column("photo_file").combine_chunks()
+        return cls(
+            table.column("x").to_numpy(),
+            table.column("y").to_numpy(),
+            table.column("photo_timestamp").to_numpy(),
+            photo_file.indices.to_numpy(zero_copy_only=False),
+            fixed_width_bytes(photo_file.dictionary),
+        )
+
+
+def fixed_width_bytes(strings):
+    """Copy an arrow string array into a numpy fixed width bytes array."""
+    offsets = np.frombuffer(strings.buffers()[1], dtype=np.int32)[
+        strings.offset : strings.offset + len(strings) + 1
+    ]
+    lengths = np.diff(offsets)
+    width = max(int(lengths.max(initial=0)), 1)
+    names = np.zeros((len(strings), width), dtype=np.uint8)
+    if lengths.sum() > 0:
+        data = np.frombuffer(strings.buffers()[2], dtype=np.uint8)[offsets[0] : offsets[-1]]
+        rows = np.repeat(np.arange(len(strings)), lengths)
+        columns = np.arange(len(data)) - np.repeat(offsets[:-1] - offsets[0], lengths)
+        names[rows, columns] = data
+    return names.view(f"S{width}").ravel()
@@ -0,0 +1,253 @@
+import json
+import os
+import shutil
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from common.files import file_signature
+
+CATALOG_PATH = Path("data/tile_catalog")
+
+# Grid cells are 500m, so about 1 in 10 cells lies on a tile edge and needs an exact test
+CELL_SIZE = 500
+
+# Source shapefile, the zip it is unpacked from, and the rule used where tiles overlap. The
+# orthophoto sheet is the one whose centroid is closest, while the first elevation tile is used
+CATALOGS = {
+    "orthophoto": {
+        "shapefile": "data/photo_metadata/orthophoto_tiles/20220923_Estado_Mosaicos_109_MA"  # noqa
+        "/20220923_Estado_Mosaicos_MA_MR.shp",  # noqa
+        "archive": "data/photo_metadata/fechas_ortofotos_PNOA_MA.zip",  # noqa
+        "rule": "nearest_centroid",
+    },
+    "mdt05": {
+        "shapefile": "data/digital_elevation/coverage/MDT05.shp",
+        "archive": None,
+        "rule": "first",
+    },
+}
+
+
+def main():
+    """Build the orthophoto sheet and elevation tile catalogs, if their sources have changed."""
+    for name in CATALOGS:
+        load_catalog(name)
+    print("Done")
+
+
+class TileCatalog:
+    """Find the tile covering each EPSG:25830 point, with a regular grid lookup.
+
+    Each grid cell holds the tile covering the whole cell, -1 if no tile touches it, or an
+    index into a list of candidate tiles for cells on tile edges. Only points in edge cells are
+    tested against the tile polygons, which are parsed the first time they are needed. The grid
+    is memory mapped, so loading a catalog does not read any shapefiles.
+    """
+
+    def __init__(self, name, path=CATALOG_PATH):
+        path = Path(path)
+        with open(path / f"{name}.json") as f:
+            self.header = json.load(f)
+        self.rule = self.header["rule"]
+        self.cell_size = self.header["cell_size"]
+        self.min_x, self.min_y = self.header["min_x"], self.header["min_y"]
+        self.tiles = pd.read_parquet(path / f"{name}_tiles.parquet")
+        self.grid = np.load(path / f"{name}_grid.npy", mmap_mode="r")
+        with np.load(path / f"{name}_candidates.npz") as candidates:
+            self.candidate_offsets = candidates["offsets"]
+            self.candidate_tiles = candidates["tiles"]
+        self._geometries = None
+
+    @property
+    def metadata(self):
+        """Tile attributes from the shapefile, in the original order, without geometries."""
+        return self.tiles.drop(columns=["geometry_wkb", "centroid_x", "centroid_y"])
+
+    @property
+    def geometries(self):
+        if self._geometries is None:
+            self._geometries = shapely.from_wkb(self.tiles.geometry_wkb.to_numpy())
+        return self._geometries
+
+    def lookup(self, x_coordinates, y_coordinates):
+        """Return the position of the tile containing each point, or -1 outside every tile."""
+        x_coordinates = np.atleast_1d(np.asarray(x_coordinates, dtype=float))
+        y_coordinates = np.atleast_1d(np.asarray(y_coordinates, dtype=float))
+        columns = np.floor((x_coordinates - self.min_x) / self.cell_size)
+        rows = np.floor((y_coordinates - self.min_y) / self.cell_size)
+        in_grid = (
+            (columns >= 0)
+            & (columns < self.grid.shape[1])
+            & (rows >= 0)
+            & (rows < self.grid.shape[0])
+        )
+        tile_positions = np.full(len(x_coordinates), -1, dtype=np.int64)
+        tile_positions[in_grid] = self.grid[
+            rows[in_grid].astype(np.int64), columns[in_grid].astype(np.int64)
+        ]
+
+        edge_points = np.flatnonzero(tile_positions <= -2)
+        if len(edge_points) > 0:
+            tile_positions[edge_points] = self.resolve_edges(
+                -tile_positions[edge_points] - 2,
+                x_coordinates[edge_points],
+                y_coordinates[edge_points],
+            )
+        return tile_positions
+
+    def resolve_edges(self, edge_cells, x_coordinates, y_coordinates):
+        """Test points in edge cells against the polygons of each candidate tile."""
+        starts = self.candidate_offsets[edge_cells]
+        counts = self.candidate_offsets[edge_cells + 1] - starts
+        point_positions = np.repeat(np.arange(len(edge_cells)), counts)
+        candidate_positions = (
+            np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        )
+        tile_positions = self.candidate_tiles[candidate_positions]
+        inside = shapely.contains_xy(
+            self.geometries[tile_positions],
+            x_coordinates[point_positions],
+            y_coordinates[point_positions],
+        )
+        point_positions, tile_positions = point_positions[inside], tile_positions[inside]
+
+        if self.rule == "nearest_centroid":
+            distances = np.hypot(
+                x_coordinates[point_positions]
+                - self.tiles.centroid_x.to_numpy()[tile_positions],
+                y_coordinates[point_positions]
+                - self.tiles.centroid_y.to_numpy()[tile_positions],
+            )
+            order = np.lexsort((tile_positions, distances, point_positions))
+        else:
+            order = np.lexsort((tile_positions, point_positions))
+        point_positions, tile_positions = point_positions[order], tile_positions[order]
+        _, first_tiles = np.unique(point_positions, return_index=True)
+        assigned_tiles = np.full(len(edge_cells), -1, dtype=np.int64)
+        assigned_tiles[point_positions[first_tiles]] = tile_positions[first_tiles]
+        return assigned_tiles
+
+
+def load_catalog(name, path=CATALOG_PATH, build=True):
+    """Load a tile catalog, building it first if it is missing or its source has changed.
+
+    If build is False the catalog is opened without checking its source, as in worker processes
+    which must not rebuild it while other workers have it open.
+    """
+    if not build:
+        return TileCatalog(name, path)
+    source = CATALOGS[name]
+    source_path = Path(source["archive"] or source["shapefile"])
+    try:
+        with open(Path(path) / f"{name}.json") as f:
+            header = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        header = {}
+    # Catalogs can be copied to workers without the source shapefiles
+    signature = file_signature(source_path) if source_path.exists() else None
+    if signature is not None and header.get("source") != signature:
+        if source["archive"] is not None:
+            shutil.unpack_archive(source["archive"], "data/photo_metadata/orthophoto_tiles")
+        build_catalog(name, source["shapefile"], source["rule"], source_path, path=path)
+    return TileCatalog(name, path)
+
+
+def build_catalog(name, shapefile, rule, source_path, cell_size=CELL_SIZE, path=CATALOG_PATH):
+    """Rasterise the tiles in a shapefile onto a grid, and save the catalog files.
+
+    Each tile is compared with the grid cells in its bounding box. Cells inside a single tile,
+    or inside the first of several tiles with the first rule, are resolved in the grid.
+    """
+    tiles = gpd.read_file(shapefile)
+    if tiles.crs is not None:
+        tiles = tiles.to_crs("EPSG:25830")
+    geometries = tiles.geometry.to_numpy()
+    min_x, min_y, max_x, max_y = tiles.total_bounds
+    min_x = np.floor(min_x / cell_size) * cell_size
+    min_y = np.floor(min_y / cell_size) * cell_size
+    num_columns = int(np.ceil((max_x - min_x) / cell_size)) + 1
+    num_rows = int(np.ceil((max_y - min_y) / cell_size)) + 1
+
+    cell_list, tile_list, inside_list = [], [], []
+    for tile_position, geometry in enumerate(geometries):
+        left, bottom, right, top = geometry.bounds
+        columns = np.arange(
+            int((left - min_x) // cell_size), int((right - min_x) // cell_size) + 1
+        )
+        rows = np.arange(int((bottom - min_y) // cell_size), int((top - min_y) // cell_size) + 1)
+        column_grid, row_grid = (grid.ravel() for grid in np.meshgrid(columns, rows))
+        cells = shapely.box(
+            min_x + column_grid * cell_size,
+            min_y + row_grid * cell_size,
+            min_x + (column_grid + 1) * cell_size,
+            min_y + (row_grid + 1) * cell_size,
+        )
+        touched = shapely.intersects(geometry, cells)
+        cell_list.append(row_grid[touched] * num_columns + column_grid[touched])
+        tile_list.append(np.full(touched.sum(), tile_position))
+        inside_list.append(shapely.contains_properly(geometry, cells[touched]))
+
+    cell_tiles = pd.DataFrame(
+        {
+            "cell": np.concatenate(cell_list),
+            "tile": np.concatenate(tile_list),
+            "inside": np.concatenate(inside_list),
+        }
+    ).sort_values(["cell", "tile"], ignore_index=True)
+    cells = cell_tiles.groupby("cell", sort=True)
+    first_tiles = cells.nth(0).set_index("cell")
+    num_tiles = cells.size()
+    if rule == "first":
+        resolved = first_tiles.inside
+    else:
+        resolved = first_tiles.inside & num_tiles.eq(1)
+
+    grid = np.full(num_rows * num_columns, -1, dtype=np.int32)
+    grid[resolved.index[resolved]] = first_tiles.tile[resolved].to_numpy()
+    edge_cells = resolved.index[~resolved].to_numpy()
+    grid[edge_cells] = -2 - np.arange(len(edge_cells))
+    edge_tiles = cell_tiles[cell_tiles.cell.isin(edge_cells)]
+    candidate_offsets = np.concatenate(
+        [[0], np.cumsum(edge_tiles.groupby("cell", sort=True).size().to_numpy())]
+    )
+
+    # Readers memory map the catalog files, so write each one to a temporary name and move it
+    # into place. The header is moved last, so that a partially built catalog is not complete
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    temporary_name = f"{name}.{os.getpid()}.tmp"
+    centroids = tiles.geometry.centroid
+    pd.DataFrame(tiles.drop(columns="geometry")).assign(
+        geometry_wkb=shapely.to_wkb(geometries),
+        centroid_x=centroids.x.to_numpy(),
+        centroid_y=centroids.y.to_numpy(),
+    ).to_parquet(path / f"{temporary_name}_tiles.parquet", index=False)
+    with open(path / f"{temporary_name}_grid.npy", "wb") as f:
+        np.save(f, grid.reshape(num_rows, num_columns))
+    with open(path / f"{temporary_name}_candidates.npz", "wb") as f:
+        np.savez(f, offsets=candidate_offsets, tiles=edge_tiles.tile.to_numpy(dtype=np.int64))
+    with open(path / f"{temporary_name}.json", "w") as f:
+        json.dump(
+            {
+                "source": file_signature(source_path),
+                "rule": rule,
+                "cell_size": cell_size,
+                "min_x": float(min_x),
+                "min_y": float(min_y),
+                "num_tiles": len(tiles),
+                "edge_cells": len(edge_cells),
+            },
+            f,
+            indent=2,
+        )
+    for suffix in ["_tiles.parquet", "_grid.npy", "_candidates.npz", ".json"]:
+        os.replace(path / f"{temporary_name}{suffix}", path / f"{name}{suffix}")
+    print(f"Built {name} catalog of {len(tiles)} tiles, with {len(edge_cells)} edge cells")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+import collections
+import concurrent.futures
+import functools
+import itertools
+import math
+import os
+from pathlib import Path
+
+import dotenv
+import numpy as np
+import pandas as pd
+from osgeo import gdal  # noqa
+
+from common.profiling import profiler
+from evaluate import detectors
+
+# Windows match the 2km site images that the turbine shadow model was trained on, resized to
+# 640px. Windows overlap by more than the width of a turbine and its shadow
+WINDOW_WIDTH = 2000
+WINDOW_OVERLAP = 300
+OUTPUT_SIZE = 640
+
+DETECTION_COLUMNS = ["label", "x", "y", "width", "height", "confidence", "orthophoto"]
+
+# Each worker process opens the orthophoto and loads the detector once
+worker_state = {}
+
+
+def main(
+    orthophoto_names=None,
+    zone=None,
+    model_path="turbine_shadow_model/runs/train/026_additional_labels_mixup/weights/best.onnx",
+    workers=None,
+):
+    """Detect turbines across whole orthophotos, rather than only around known sites.
+
+    By default every orthophoto in data/orthophotos is scanned. If zone is set, every sheet in
+    the UTM zone is scanned as one mosaic, so turbines on the edges of sheets are found once.
+    Detections are saved in map coordinates to data/turbine_detections.csv.
+    """
+    dotenv.load_dotenv(".env")
+    dotenv.load_dotenv(".env.secret")
+    if zone is not None:
+        orthophoto_paths = build_zone_mosaic(zone)
+    elif orthophoto_names is None:
+        orthophoto_paths = sorted(Path("data/orthophotos").glob("*.ecw"))
+    else:
+        orthophoto_paths = [Path(f"data/orthophotos/{name}.ecw") for name in orthophoto_names]
+
+    detector_factory = functools.partial(detectors.OnnxDetector, model_path)
+    detection_list = []
+    for orthophoto_path in orthophoto_paths:
+        with profiler.stage("tile_orthophotos.detect"):
+            detections = detect_orthophoto(orthophoto_path, detector_factory, workers=workers)
+        print(f"{Path(orthophoto_path).stem}: {len(detections)} detections")
+        detection_list.append(detections)
+
+    if len(detection_list) == 0:
+        print("No orthophotos found, so no turbines were detected.")
+        detections = pd.DataFrame(columns=DETECTION_COLUMNS)
+    else:
+        detections = pd.concat(detection_list, ignore_index=True)
+    detections.to_csv("data/turbine_detections.csv", index=False)
+    profiler.save("data/tile_orthophotos")
+    print("Done")
+
+
+def build_zone_mosaic(zone):
+    """Write a VRT of every orthophoto sheet in a UTM zone, which workers can open by path.
+
+    Returns a list with the path of the mosaic, which is empty if the zone has no sheets.
+    """
+    orthophoto_paths = sorted(Path("data/orthophotos").glob(f"PNOA_MA_OF_ETRS89_HU{zone}_*.ecw"))
+    if len(orthophoto_paths) == 0:
+        return []
+    mosaic_path = Path(f"data/orthophotos/zone_{zone}.vrt")
+    gdal.BuildVRT(str(mosaic_path), [str(path) for path in orthophoto_paths]).FlushCache()
+    return [mosaic_path]
+
+
+def window_offsets(raster_size, window_size, overlap):
+    """Offsets of windows covering one axis of a raster, with the last window at the edge."""
+    if raster_size <= window_size:
+        return [0]
+    stride = window_size - overlap
+    num_windows = math.ceil((raster_size - window_size) / stride) + 1
+    return [min(window * stride, raster_size - window_size) for window in range(num_windows)]
+
+
+def iter_windows(raster_x_size, raster_y_size, window_size, overlap):
+    """Generate (left, top, width, height) pixel windows, with the part of each that it owns.
+
+    The owned part ends halfway through the overlap with the next window, so the owned parts
+    tile the raster exactly. Each detection is kept only by the window which owns its centre.
+    """
+    x_offsets = window_offsets(raster_x_size, window_size, overlap)
+    y_offsets = window_offsets(raster_y_size, window_size, overlap)
+    x_bounds = owned_bounds(x_offsets, raster_x_size, window_size)
+    y_bounds = owned_bounds(y_offsets, raster_y_size, window_size)
+    for top, (own_top, own_bottom) in zip(y_offsets, y_bounds):
+        for left, (own_left, own_right) in zip(x_offsets, x_bounds):
+            yield {
+                "left": left,
+                "top": top,
+                "width": min(window_size, raster_x_size - left),
+                "height": min(window_size, raster_y_size - top),
+                "own_left": own_left,
+                "own_right": own_right,
+                "own_top": own_top,
+                "own_bottom": own_bottom,
+            }
+
+
+def owned_bounds(offsets, raster_size, window_size):
+    # Each boundary is the middle of the overlap between neighbouring windows
+    middles = [(offsets[i + 1] + offsets[i] + window_size) / 2 for i in range(len(offsets) - 1)]
+    return list(zip([0] + middles, middles + [raster_size]))
+
+
+def read_window(dataset, window, output_size=OUTPUT_SIZE):
+    """Read a window resampled to output_size, returning an RGB array and its geotransform.
+
+    ECW and COG orthophotos decode reduced resolution windows directly, so only the pixels
+    which are needed are read.
+    """
+    geo_transform = dataset.GetGeoTransform()
+    image_data = dataset.ReadAsArray(
+        window["left"],
+        window["top"],
+        window["width"],
+        window["height"],
+        buf_xsize=output_size,
+        buf_ysize=output_size,
+        band_list=[1, 2, 3],
+    )
+    window_geo_transform = (
+        geo_transform[0] + window["left"] * geo_transform[1],
+        geo_transform[1] * window["width"] / output_size,
+        0,
+        geo_transform[3] + window["top"] * geo_transform[5],
+        0,
+        geo_transform[5] * window["height"] / output_size,
+    )
+    return np.ascontiguousarray(image_data.transpose(1, 2, 0)), window_geo_transform
+
+
+def stream_windows(
+    orthophoto_path, window_width=WINDOW_WIDTH, overlap=WINDOW_OVERLAP, output_size=OUTPUT_SIZE
+):
+    """Generate (array, geotransform) for overlapping windows across a whole orthophoto.
+
+    Window width and overlap are in metres. Only one window is held in memory at a time.
+    """
+    dataset = gdal.Open(str(orthophoto_path))
+    window_size, overlap_size = window_pixels(dataset, window_width, overlap)
+    for window in iter_windows(dataset.RasterXSize, dataset.RasterYSize, window_size, overlap_size):
+        yield read_window(dataset, window, output_size)
+
+
+def window_pixels(dataset, window_width, overlap):
+    resolution = dataset.GetGeoTransform()[1]
+    return int(round(window_width / resolution)), int(round(overlap / resolution))
+
+
+def detect_orthophoto(
+    orthophoto_path,
+    detector_factory,
+    window_width=WINDOW_WIDTH,
+    overlap=WINDOW_OVERLAP,
+    output_size=OUTPUT_SIZE,
+    iou_threshold=0.45,
+    workers=None,
+):
+    """Detect objects across a whole orthophoto, in a pool of worker processes.
+
+    Workers read their own windows, so only window offsets and detections are passed between
+    processes. At most two batches of windows per worker are submitted at a time, so memory
+    does not depend on the size of the orthophoto. Detections are returned in map coordinates,
+    after removing duplicates from overlapping windows.
+    """
+    dataset = gdal.Open(str(orthophoto_path))
+    window_size, overlap_size = window_pixels(dataset, window_width, overlap)
+    windows = iter_windows(dataset.RasterXSize, dataset.RasterYSize, window_size, overlap_size)
+    batches = batched(windows, detectors.Detector.batch_size)
+    workers = workers or os.cpu_count() or 1
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=init_worker,
+        initargs=(str(orthophoto_path), detector_factory),
+    ) as executor:
+        detect = functools.partial(detect_windows, output_size=output_size)
+        futures = collections.deque(
+            executor.submit(detect, batch) for batch in itertools.islice(batches, 2 * workers)
+        )
+        window_detections = []
+        while len(futures) > 0:
+            window_detections.append(futures.popleft().result())
+            for batch in itertools.islice(batches, 1):
+                futures.append(executor.submit(detect, batch))
+    profiler.count("tile_orthophotos.windows", sum(len(d) for d in window_detections))
+
+    detections = pd.DataFrame(
+        [detection for batch in window_detections for d in batch for detection in d],
+        columns=DETECTION_COLUMNS[:-1],
+    ).assign(orthophoto=Path(orthophoto_path).stem)
+    return merge_detections(detections, iou_threshold)
+
+
+def batched(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def init_worker(orthophoto_path, detector_factory):
+    worker_state["dataset"] = gdal.Open(orthophoto_path)
+    worker_state["detector"] = detector_factory()
+
+
+def detect_windows(windows, output_size=OUTPUT_SIZE):
+    """Detect a batch of windows, returning the detections owned by each window."""
+    dataset, detector = worker_state["dataset"], worker_state["detector"]
+    images, geo_transforms = zip(*[read_window(dataset, window, output_size) for window in windows])
+    window_labels = detector.detect(list(images))
+    return [
+        window_to_map(labels, window, geo_transform, output_size)
+        for labels, window, geo_transform in zip(window_labels, windows, geo_transforms)
+    ]
+
+
+def window_to_map(labels, window, geo_transform, output_size):
+    """Convert relative labels to map coordinates, keeping labels centred in the owned area."""
+    labels = np.asarray(labels, dtype=float).reshape(-1, len(detectors.LABEL_COLUMNS))
+    label, center_x, center_y, width, height, confidence = labels.T
+    pixel_x = window["left"] + center_x * window["width"]
+    pixel_y = window["top"] + center_y * window["height"]
+    owned = (
+        (pixel_x >= window["own_left"])
+        & (pixel_x < window["own_right"])
+        & (pixel_y >= window["own_top"])
+        & (pixel_y < window["own_bottom"])
+    )
+    map_x = geo_transform[0] + center_x * output_size * geo_transform[1]
+    map_y = geo_transform[3] + center_y * output_size * geo_transform[5]
+    map_width = width * output_size * geo_transform[1]
+    map_height = height * output_size * -geo_transform[5]
+    return [
+        (int(label[i]), map_x[i], map_y[i], map_width[i], map_height[i], confidence[i])
+        for i in np.flatnonzero(owned)
+    ]
+
+
+def merge_detections(detections, iou_threshold=0.45):
+    """Remove duplicates of objects on window seams, with non-maximum suppression per label.
+
+    Boxes are compared in map coordinates, so windows with different resolutions or from
+    neighbouring sheets are merged in the same way.
+    """
+    keep = []
+    for _, label_detections in detections.groupby("label"):
+        selected = detectors.non_max_suppression(
+            label_detections[["x", "y", "width", "height"]].to_numpy(),
+            label_detections.confidence.to_numpy(),
+            iou_threshold,
+        )
+        keep.extend(label_detections.index[selected])
+    return (
+        detections.loc[keep]
+        .sort_values(["confidence", "x", "y"], ascending=[False, True, False])
+        .reset_index(drop=True)
+    )
+
+
+if __name__ == "__main__":
+    main()